@@ -856,6 +856,10 @@ async def start_login_sequence():
     # implement idle timeout now that we are logged-in
     IMPT.start_task('idle', idle_logout())
 
+    # build address ownership data while they aren't doing anything
+    from ownership import OWNERSHIP
+    IMPT.start_task('own-bg', OWNERSHIP.background_builder())
+
     # Populate xfp/xpub values, if missing.
     # - can happen for first-time login of duress wallet
     # - may indicate lost settings, which we can easily recover from
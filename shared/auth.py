@@ -21,12 +21,21 @@ from psbt import psbtObject, FatalPSBTIssue, FraudulentChangeOutput
 from files import CardSlot
 from exceptions import HSMDenied
 from version import MAX_TXN_LEN
+from perf import PERF
 from charcodes import KEY_QR, KEY_NFC, KEY_ENTER, KEY_CANCEL
 
 # Where in SPI flash/PSRAM the two PSBT files are (in and out)
 TXN_INPUT_OFFSET = 0
 TXN_OUTPUT_OFFSET = MAX_TXN_LEN
 
+# Batch signing: same PSRAM area, split into slots of (input, output) pairs
+BATCH_SLOT_SIZE = const(64*1024)
+BATCH_MAX_SLOTS = const(32)         # = (2 * MAX_TXN_LEN) // (2 * BATCH_SLOT_SIZE)
+
+def batch_slot_offset(slot, is_output=False):
+    assert 0 <= slot < BATCH_MAX_SLOTS, 'bad slot'
+    return ((2 * slot) + (1 if is_output else 0)) * BATCH_SLOT_SIZE
+
 class UserAuthorizedAction:
     active_request = None
 
@@ -629,11 +638,13 @@ class ApproveTransaction(UserAuthorizedAction):
         from glob import dis, hsm_active
 
         # step 1: parse PSBT from PSRAM into in-memory objects.
+        PERF.reset()
 
         try:
             with SFFile(TXN_INPUT_OFFSET, length=self.psbt_len, message='Reading...') as fd:
                 # NOTE: psbtObject captures the file descriptor and uses it later
-                self.psbt = psbtObject.read_psbt(fd)
+                with PERF.phase('read_psbt'):
+                    self.psbt = psbtObject.read_psbt(fd)
         except BaseException as exc:
             if isinstance(exc, MemoryError):
                 msg = "Transaction is too complex"
@@ -647,15 +658,18 @@ class ApproveTransaction(UserAuthorizedAction):
 
         # Do some analysis/ validation
         try:
-            await self.psbt.validate()      # might do UX: accept multisig import
+            with PERF.phase('validate'):
+                await self.psbt.validate()      # might do UX: accept multisig import
             dis.progress_bar_show(0.10)
-            self.psbt.consider_inputs()
+            with PERF.phase('consider_inputs'):
+                self.psbt.consider_inputs()
 
             dis.progress_bar_show(0.33)
             self.psbt.consider_keys()
 
             dis.progress_bar_show(0.66)
-            self.psbt.consider_outputs()
+            with PERF.phase('consider_outputs'):
+                self.psbt.consider_outputs()
             self.psbt.consider_dangerous_sighash()
 
             dis.progress_bar_show(0.85)
@@ -740,7 +754,8 @@ class ApproveTransaction(UserAuthorizedAction):
                 msg.write(" X to abort.")
                 ch = await ux_show_story(msg, title="OK TO SEND?", escape="b")
             else:
-                ch = await hsm_active.approve_transaction(self.psbt, self.psbt_sha, msg.getvalue())
+                with PERF.phase('approve_transaction'):
+                    ch = await hsm_active.approve_transaction(self.psbt, self.psbt_sha, msg.getvalue())
                 dis.progress_bar_show(1)     # finish the Validating...
 
         except MemoryError:
@@ -769,7 +784,9 @@ class ApproveTransaction(UserAuthorizedAction):
         try:
             dis.fullscreen('Wait...')
             gc.collect()           # visible delay caused by this but also sign_it() below
-            self.psbt.sign_it()
+            self.psbt.stage_hook = PERF.stage_hook('sign_it')
+            with PERF.phase('sign_it'):
+                self.psbt.sign_it()
         except FraudulentChangeOutput as exc:
             return await self.failure(exc.args[0], title='Change Fraud')
         except MemoryError:
@@ -794,9 +811,11 @@ class ApproveTransaction(UserAuthorizedAction):
                 await fd.erase()
 
                 if self.do_finalize:
-                    txid = self.psbt.finalize(fd)
+                    with PERF.phase('finalize'):
+                        txid = self.psbt.finalize(fd)
                 else:
-                    self.psbt.serialize(fd)
+                    with PERF.phase('serialize'):
+                        self.psbt.serialize(fd)
 
                 fd.close()
                 self.result = (fd.tell(), fd.checksum.digest())
@@ -982,6 +1001,189 @@ def sign_transaction(psbt_len, flags=0x0, psbt_sha=None):
     # kill any menu stack, and put our thing at the top
     abort_and_goto(UserAuthorizedAction.active_request)
 
+class ApproveBatch(ApproveTransaction):
+    # Sign many PSBT's, already uploaded into PSRAM slots, with a single approval.
+    # - or in HSM mode, each PSBT is checked against policy on its own
+    # - result is list of (status, length, sha256) per slot
+
+    SIGNED = 0
+    REFUSED = 1
+    FAILED = 2
+
+    def __init__(self, items, flags=0x0):
+        super().__init__(0, flags & STXN_FINALIZE)
+        self.items = items          # (psbt_len, psbt_sha) for each slot in use
+
+    async def load(self, slot):
+        # parse and validate one PSBT; raises on any issue
+        from glob import PSRAM
+
+        psbt_len, psbt_sha = self.items[slot]
+        offset = batch_slot_offset(slot)
+
+        # also catches any change since upload
+        if sha256(PSRAM.read_at(offset, psbt_len)).digest() != psbt_sha:
+            raise FatalPSBTIssue('Checksum')
+
+        with SFFile(offset, length=psbt_len) as fd:
+            psbt = psbtObject.read_psbt(fd)
+
+        await psbt.validate()
+        psbt.consider_inputs()
+        psbt.consider_keys()
+        psbt.consider_outputs()
+        psbt.consider_dangerous_sighash()
+
+        return psbt
+
+    def save(self, slot):
+        # sign and write out result into output side of slot
+        self.psbt.sign_it()
+
+        with SFFile(batch_slot_offset(slot, True), max_size=BATCH_SLOT_SIZE) as fd:
+            if self.do_finalize:
+                self.psbt.finalize(fd)
+            else:
+                self.psbt.serialize(fd)
+
+            fd.close()
+            return (self.SIGNED, fd.tell(), fd.checksum.digest())
+
+    def summary_text(self, msg):
+        # short version of ApproveTransaction story, for one PSBT
+        self.output_summary_text(msg)
+
+        fee = self.psbt.calculate_fee()
+        if fee is not None:
+            msg.write("Network fee:\n%s %s\n\n" % self.chain.render_value(fee))
+
+        self.output_change_text(msg)
+
+        if self.psbt.ux_notes:
+            # currently we only have locktimes in ux_notes
+            msg.write('TX LOCKTIMES\n\n')
+
+            for label, m in self.psbt.ux_notes:
+                msg.write('- %s: %s\n' % (label, m))
+            msg.write("\n")
+
+        return fee or 0
+
+    async def interact(self):
+        from glob import dis, hsm_active
+
+        if hsm_active:
+            return await self.interact_hsm(hsm_active)
+
+        # step 1: validate all, and build one story covering them all
+        num = len(self.items)
+        msg = uio.StringIO()
+        total_fee = 0
+        warnings = []
+
+        dis.fullscreen("Validating...")
+        for slot in range(num):
+            try:
+                self.psbt = await self.load(slot)
+
+                msg.write('--- Transaction %d of %d ---\n\n' % (slot+1, num))
+                total_fee += self.summary_text(msg)
+
+                for label, m in self.psbt.warnings:
+                    warnings.append('#%d %s: %s' % (slot+1, label, m))
+            except FraudulentChangeOutput as exc:
+                return await self.failure('#%d: %s' % (slot+1, exc.args[0]), title='Change Fraud')
+            except FatalPSBTIssue as exc:
+                return await self.failure('#%d: %s' % (slot+1, exc.args[0]))
+            except MemoryError:
+                return await self.failure('#%d: Transaction is too complex' % (slot+1))
+            except BaseException as exc:
+                return await self.failure('#%d: Invalid PSBT' % (slot+1), exc)
+            finally:
+                self.psbt = None
+                gc.collect()
+
+            dis.progress_sofar(slot+1, num)
+
+        story = uio.StringIO()
+        if warnings:
+            story.write('(%d warnings below)\n\n' % len(warnings))
+        story.write('%d transactions.\n\nTotal network fees:\n%s %s\n\n'
+                        % ((num,) + self.chain.render_value(total_fee)))
+        story.write(msg.getvalue())
+        del msg
+
+        if warnings:
+            story.write('---WARNING---\n\n')
+            for w in warnings:
+                story.write('- %s\n\n' % w)
+
+        story.write("Press OK to approve and sign all %d transactions. X to abort." % num)
+
+        ux_clear_keys(True)
+        ch = await ux_show_story(story, title="OK TO SEND?")
+        del story
+
+        if ch != 'y':
+            self.refused = True
+            await ux_dramatic_pause("Refused.", 1)
+            self.done()
+            return
+
+        # step 2: sign them all, back to back. Re-parse since can't hold all in memory
+        dis.fullscreen('Wait...')
+        result = []
+        for slot in range(num):
+            try:
+                self.psbt = await self.load(slot)
+                result.append(self.save(slot))
+            except FraudulentChangeOutput as exc:
+                return await self.failure('#%d: %s' % (slot+1, exc.args[0]), title='Change Fraud')
+            except BaseException as exc:
+                return await self.failure('#%d: Signing failed late' % (slot+1), exc)
+            finally:
+                self.psbt = None
+                gc.collect()
+
+            dis.progress_sofar(slot+1, num)
+
+        self.result = result
+        self.done()
+
+    async def interact_hsm(self, hsm_active):
+        # policy is applied to each txn separately; failures don't stop the others
+        result = []
+        for slot in range(len(self.items)):
+            try:
+                self.psbt = await self.load(slot)
+
+                msg = uio.StringIO()
+                self.summary_text(msg)
+                ch = await hsm_active.approve_transaction(self.psbt, self.items[slot][1],
+                                                                msg.getvalue())
+                del msg
+
+                if ch == 'y':
+                    result.append(self.save(slot))
+                else:
+                    result.append((self.REFUSED, 0, bytes(32)))
+            except BaseException as exc:
+                sys.print_exception(exc)
+                result.append((self.FAILED, 0, bytes(32)))
+            finally:
+                self.psbt = None
+                gc.collect()
+
+        self.result = result
+        self.done()
+
+def sign_batch(items, flags=0x0):
+    # many transactions loaded into PSRAM slots already; see ApproveBatch
+    UserAuthorizedAction.check_busy()
+    UserAuthorizedAction.active_request = ApproveBatch(items, flags)
+
+    abort_and_goto(UserAuthorizedAction.active_request)
+
 def psbt_encoding_taster(taste, psbt_len):
     # look at first 10 bytes, and detect file encoding (binary, hex, base64)
     # - return len is upper bound on size because of unknown whitespace
@@ -20,108 +20,116 @@ num_pw_words = const(12)
 # - limited by size of LFS area of flash, since all settings are held there
 MAX_BACKUP_FILE_SIZE = const(128*1024)     # bytes
 
-def render_backup_contents(bypass_tmp=False):
+def render_backup_contents(bypass_tmp=False, fd=None):
     # simple text format: 
     #   key = value
     # or #comments
     # but value is JSON
+    # - streams UTF-8 into fd if provided, otherwise returns the text
     current_tmp = None
-    rv = StringIO()
+    if fd is None:
+        rv = StringIO()
+        out = rv.write
+    else:
+        out = lambda s: fd.write(s.encode())
 
     def COMMENT(val=None):
         if val:
-            rv.write('\n# %s\n' % val)
+            out('\n# %s\n' % val)
         else:
-            rv.write('\n')
+            out('\n')
 
     def ADD(key, val):
-        rv.write('%s = %s\n' % (key, ujson.dumps(val)))
+        out('%s = %s\n' % (key, ujson.dumps(val)))
 
-    rv.write('# Coldcard backup file! DO NOT CHANGE.\n')
+    out('# Coldcard backup file! DO NOT CHANGE.\n')
 
     chain = chains.current_chain()
 
-    COMMENT('Private key details: ' + chain.name)
-
-    with stash.SensitiveValues(bypass_tmp=bypass_tmp) as sv:
-        if sv.deltamode:
-            # die rather than give up our secrets
-            import callgate
-            callgate.fast_wipe()
-
-        if sv.mode == 'words':
-            ADD('mnemonic', bip39.b2a_words(sv.raw))
-
-        if sv.mode == 'master':
-            ADD('bip32_master_key', b2a_hex(sv.raw))
-
-        ADD('chain', chain.ctype)
-        ADD('xprv', chain.serialize_private(sv.node))
-        ADD('xpub', chain.serialize_public(sv.node))
-
-        # BTW: everything is really a duplicate of this value
-        ADD('raw_secret', b2a_hex(sv.secret).rstrip(b'0'))
-
-        if version.has_608:
-            # save the so-called long-secret
-            ADD('long_secret', b2a_hex(pa.ls_fetch()))
-
-        # Duress wallets (somewhat optional, since derived)
-        from trick_pins import tp
-        for label, path, pairs in tp.backup_duress_wallets(sv):
-            COMMENT()
-            COMMENT(label + ' (informational)')
-            COMMENT(path)
-            for k,v in pairs:
-                ADD(k, v)
-
-        if bypass_tmp and pa.tmp_value:
-            current_tmp = pa.tmp_value[:]
-            pa.tmp_value = None
-            # we also need correct settings from main seed
-            nv = stash.SecretStash.encode(seed_phrase=sv.raw)
-            settings.set_key(nv)
-            settings.load()
-            stash.blank_object(nv)
-    
-    COMMENT('Firmware version (informational)')
-    date, vers, timestamp = version.get_mpy_version()[0:3]
-    ADD('fw_date', date)
-    ADD('fw_version', vers)
-    ADD('fw_timestamp', timestamp)
-    COMMENT('Coldcard Hardware')
-    ADD('serial', version.serial_number())
-    ADD('hardware', version.hw_label)
-
-    COMMENT('User preferences')
-
-    # user preferences
-    for k,v in settings.current.items():
-        if k[0] == '_': continue        # debug stuff in simulator
-        if k == 'xpub': continue        # redundant, and wrong if bip39pw
-        if k == 'xfp': continue         # redundant, and wrong if bip39pw
-        if k == 'bkpw': continue        # confusing/circular
-        if k == 'sd2fa': continue       # do NOT backup SD 2FA (card can be lost or damaged)
-        if k == 'words': continue       # words length is recalculated from secret
-        if k == 'seedvault' and not v: continue
-        if k == 'seeds' and not v: continue
-        ADD('setting.' + k, v)
-
-    if version.supports_hsm:
-        import hsm
-        if hsm.hsm_policy_available():
-            ADD('hsm_policy', hsm.capture_backup())
+    try:
+        COMMENT('Private key details: ' + chain.name)
+
+        with stash.SensitiveValues(bypass_tmp=bypass_tmp) as sv:
+            if sv.deltamode:
+                # die rather than give up our secrets
+                import callgate
+                callgate.fast_wipe()
+
+            if sv.mode == 'words':
+                ADD('mnemonic', bip39.b2a_words(sv.raw))
 
-    rv.write('\n# EOF\n')
+            if sv.mode == 'master':
+                ADD('bip32_master_key', b2a_hex(sv.raw))
 
-    if bypass_tmp and current_tmp:
-        # go back to tmp secret and its settings
-        stash.SensitiveValues.clear_cache()
-        pa.tmp_value = current_tmp
-        settings.set_key()
-        settings.load()
+            ADD('chain', chain.ctype)
+            ADD('xprv', chain.serialize_private(sv.node))
+            ADD('xpub', chain.serialize_public(sv.node))
 
-    return rv.getvalue()
+            # BTW: everything is really a duplicate of this value
+            ADD('raw_secret', b2a_hex(sv.secret).rstrip(b'0'))
+
+            if version.has_608:
+                # save the so-called long-secret
+                ADD('long_secret', b2a_hex(pa.ls_fetch()))
+
+            # Duress wallets (somewhat optional, since derived)
+            from trick_pins import tp
+            for label, path, pairs in tp.backup_duress_wallets(sv):
+                COMMENT()
+                COMMENT(label + ' (informational)')
+                COMMENT(path)
+                for k,v in pairs:
+                    ADD(k, v)
+
+            if bypass_tmp and pa.tmp_value:
+                current_tmp = pa.tmp_value[:]
+                pa.tmp_value = None
+                # we also need correct settings from main seed
+                nv = stash.SecretStash.encode(seed_phrase=sv.raw)
+                settings.set_key(nv)
+                settings.load()
+                stash.blank_object(nv)
+    
+        COMMENT('Firmware version (informational)')
+        date, vers, timestamp = version.get_mpy_version()[0:3]
+        ADD('fw_date', date)
+        ADD('fw_version', vers)
+        ADD('fw_timestamp', timestamp)
+        COMMENT('Coldcard Hardware')
+        ADD('serial', version.serial_number())
+        ADD('hardware', version.hw_label)
+
+        COMMENT('User preferences')
+
+        # user preferences
+        for k,v in settings.current.items():
+            if k[0] == '_': continue        # debug stuff in simulator
+            if k == 'xpub': continue        # redundant, and wrong if bip39pw
+            if k == 'xfp': continue         # redundant, and wrong if bip39pw
+            if k == 'bkpw': continue        # confusing/circular
+            if k == 'sd2fa': continue       # do NOT backup SD 2FA (card can be lost or damaged)
+            if k == 'words': continue       # words length is recalculated from secret
+            if k == 'seedvault' and not v: continue
+            if k == 'seeds' and not v: continue
+            ADD('setting.' + k, v)
+
+        if version.supports_hsm:
+            import hsm
+            if hsm.hsm_policy_available():
+                ADD('hsm_policy', hsm.capture_backup())
+
+        out('\n# EOF\n')
+
+    finally:
+        if bypass_tmp and current_tmp:
+            # go back to tmp secret and its settings, even if writing failed part way
+            stash.SensitiveValues.clear_cache()
+            pa.tmp_value = current_tmp
+            settings.set_key()
+            settings.load()
+
+    if fd is None:
+        return rv.getvalue()
 
 def extract_raw_secret(chain, vals):
     # step1: the private key
@@ -389,14 +397,14 @@ async def make_complete_backup(fname_pattern='backup.7z', write_sflash=False):
 async def write_complete_backup(words, fname_pattern, write_sflash=False,
                                 allow_copies=True, bypass_tmp=False):
     # Just do the writing
+    # - contents are rendered, encrypted and written in one pass, a chunk at
+    #   a time, so never held whole in memory
+    # - done again for each copy (same key, salt and IV)
     from glob import dis
     from files import CardSlot
 
     # Show progress:
     dis.fullscreen('Encrypting...' if words else 'Generating...')
-    body = render_backup_contents(bypass_tmp=bypass_tmp).encode()
-
-    gc.collect()
 
     if words:
         # NOTE: Takes a few seconds to do the key-streching, but little actual
@@ -404,38 +412,44 @@ async def write_complete_backup(words, fname_pattern, write_sflash=False,
 
         pw = ' '.join(words)
         zz = compat7z.Builder(password=pw, progress_fcn=dis.progress_bar_show)
-        zz.add_data(body)
 
         # pick random filename, but ending in .txt
         word = bip39.wordlist_en[ngu.random.uniform(2048)]
         num = ngu.random.uniform(1000)
-        fname = '%s%d.txt' % (word, num)
-
-        hdr, footer = zz.save(fname)
-
-        del body
-
-        gc.collect()
+        inner_fname = '%s%d.txt' % (word, num)
     else:
         # cleartext dump
         zz = None
 
+    def write_body(fd):
+        # render into fd, maybe encrypted
+        # - returns 7z headers, which must then be written at start of file
+        if not zz:
+            render_backup_contents(bypass_tmp=bypass_tmp, fd=fd)
+            return None
+
+        zz.stream_start(fd)
+        render_backup_contents(bypass_tmp=bypass_tmp, fd=zz)
+        return zz.stream_finish(inner_fname)
+
     if write_sflash:
         # for use over USB and unit testing: commit file into PSRAM
         from sffile import SFFile
+        from glob import PSRAM
+        from uhashlib import sha256
 
         with SFFile(0, max_size=MAX_BACKUP_FILE_SIZE, message='Saving...') as fd:
             await fd.erase()
+            hdr = write_body(fd)
 
-            if zz:
-                fd.write(hdr)
-                fd.write(zz.body)
-                fd.write(footer)
-            else:
-                fd.write(body)
-
+        if not hdr:
             return fd.tell(), fd.checksum.digest()
 
+        # SFFile is append-only, so fill in the headers directly
+        PSRAM.write(0, hdr)
+
+        return fd.tell(), sha256(PSRAM.read_at(0, fd.tell())).digest()
+
     for copy in range(25):
         # choose a filename
 
@@ -444,13 +458,18 @@ async def write_complete_backup(words, fname_pattern, write_sflash=False,
                 fname, nice = card.pick_filename(fname_pattern)
 
                 # do actual write
-                with card.open(fname, 'wb') as fd:
-                    if zz:
-                        fd.write(hdr)
-                        fd.write(zz.body)
-                        fd.write(footer)
-                    else:
-                        fd.write(body)
+                try:
+                    with card.open(fname, 'wb') as fd:
+                        hdr = write_body(fd)
+                        if hdr:
+                            fd.seek(0)
+                            fd.write(hdr)
+                except:
+                    # don't leave a partial (maybe cleartext) file behind
+                    try:
+                        card.securely_blank_file(fname)
+                    except: pass
+                    raise
 
         except Exception as e:
             # includes CardMissingError
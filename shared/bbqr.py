@@ -83,7 +83,7 @@ def num_qr_needed(encoding, data_len):
         char_len = data_len * 2
         split_mod = 2
     else:
-        # plan for Base32, always best option
+        # plan for Base32, always best option; also used for 'Z' (compressed) data
         # - five inputs bytes => 8 alnum chars
         # - for final set of 1-5 we remove padding == , so between 2..7 chars
         char_len = ((data_len//5) * 8) + { 0:0, 1:2, 2:4, 3:5, 4:7 }[data_len % 5]
@@ -121,6 +121,244 @@ def num_qr_needed(encoding, data_len):
     #assert part_size % split_mod == 0, (target_vers, part_size, split_mod, char_len, data_len)
     return target_vers, num_parts, pkt_size
 
+def pick_encoding(data, already_hex=False):
+    # Decide between plain (Hex or Base32) and Base32 of zlib-compressed data
+    # - compression is tried only if more than one QR would be needed otherwise
+    # - 'Z' used whenever it gives fewer parts
+    # - compressed copy lives in PSRAM, top of lower half, clear of the QR frames at zero
+    # - returns (encoding, data, data_len, target_vers, num_parts, part_size)
+    from glob import PSRAM, dis
+    from public_constants import MAX_TXN_LEN_MK4
+
+    if already_hex:
+        encoding = 'H'
+        data_len = len(data) // 2
+    else:
+        # default to Base32, because always best option
+        encoding = '2'
+        data_len = len(data)
+
+    rv = num_qr_needed(encoding, data_len)
+    if rv[1] == 1:
+        # single QR: compression cannot help
+        return (encoding, data, data_len) + rv
+
+    zoff = MAX_TXN_LEN_MK4 // 2
+
+    def chunks():
+        step = 1024
+        for pos in range(0, data_len, step):
+            if already_hex:
+                yield a2b_hex(data[pos*2:(pos+step)*2])
+            else:
+                yield data[pos:pos+step]
+
+            dis.progress_sofar(pos, data_len)
+
+    # no point keeping a compressed copy that isn't smaller
+    zlen = zlib_compress(chunks(), zoff, min(data_len, zoff))
+    if not zlen:
+        return (encoding, data, data_len) + rv
+
+    zrv = num_qr_needed('Z', zlen)
+    if zrv[1] >= rv[1] or (zrv[1] * QR_SLOT_MAX) > zoff:
+        # no gain, or frames would overwrite the compressed copy
+        return (encoding, data, data_len) + rv
+
+    return ('Z', PSRAM.read_at(zoff, zlen), zlen) + zrv
+
+# Compression (raw deflate, fixed Huffman codes)
+#
+# - window of 1024 bytes, so receivers use: uzlib.decompress(buf, -10)
+# - Huffman codes here are pre-combined with any extra bits, and bit-reversed
+#   so they can be shifted directly into the LSB-first output stream
+#
+ZLIB_WBITS = 10
+MAX_MATCH = 258
+QR_SLOT_MAX = 4096          # bytes needed for one pre-rendered (packed) QR v40
+
+LEN_BASE = [3, 4, 5, 6, 7, 8, 9, 10, 11, 13, 15, 17, 19, 23, 27, 31, 35, 43, 51, 59,
+                67, 83, 99, 115, 131, 163, 195, 227, 258]
+LEN_EXTRA = [0]*8 + [1]*4 + [2]*4 + [3]*4 + [4]*4 + [5]*4 + [0]
+DIST_BASE = [1, 2, 3, 4, 5, 7, 9, 13, 17, 25, 33, 49, 65, 97, 129, 193, 257, 385, 513, 769]
+DIST_EXTRA = [0, 0, 0, 0, 1, 1, 2, 2, 3, 3, 4, 4, 5, 5, 6, 6, 7, 7, 8, 8]
+
+_ztables = None
+
+def _bit_rev(code, nbits):
+    rv = 0
+    for _ in range(nbits):
+        rv = (rv << 1) | (code & 1)
+        code >>= 1
+    return rv
+
+def _fixed_code(sym):
+    # fixed Huffman code for a literal/length symbol: (bit-reversed code, num bits)
+    if sym < 144:
+        return _bit_rev(0x30 + sym, 8), 8
+    if sym < 256:
+        return _bit_rev(0x190 + sym - 144, 9), 9
+    if sym < 280:
+        return _bit_rev(sym - 256, 7), 7
+    return _bit_rev(0xc0 + sym - 280, 8), 8
+
+def _zlib_tables():
+    # build on first use, then keep: about 3.5k of RAM
+    global _ztables
+    if _ztables:
+        return _ztables
+
+    from array import array
+
+    lit_v = array('H', bytes(2 * 256))
+    lit_n = bytearray(256)
+    for b in range(256):
+        lit_v[b], lit_n[b] = _fixed_code(b)
+
+    # - symbol 285 overwrites 258, which symbol 284 could also (wrongly) express
+    len_v = array('H', bytes(2 * (MAX_MATCH+1)))
+    len_n = bytearray(MAX_MATCH+1)
+    for i, base in enumerate(LEN_BASE):
+        code, nb = _fixed_code(257 + i)
+        ex = LEN_EXTRA[i]
+        for ln in range(base, min(base + (1 << ex), MAX_MATCH+1)):
+            len_v[ln] = code | ((ln - base) << nb)
+            len_n[ln] = nb + ex
+
+    window = 1 << ZLIB_WBITS
+    dist_v = array('H', bytes(2 * (window+1)))
+    dist_n = bytearray(window+1)
+    for i, base in enumerate(DIST_BASE):
+        code = _bit_rev(i, 5)
+        ex = DIST_EXTRA[i]
+        for d in range(base, min(base + (1 << ex), window+1)):
+            dist_v[d] = code | ((d - base) << 5)
+            dist_n[d] = 5 + ex
+
+    _ztables = (lit_v, lit_n, len_v, len_n, dist_v, dist_n)
+
+    return _ztables
+
+def zlib_compress(chunks, offset, max_size):
+    # Streaming raw-deflate of chunks (iterable of bytes) into PSRAM at offset
+    # - RAM use is one window of history, plus a chunk, plus output staging
+    # - greedy longest match, found by the C code in bytes.rfind()
+    # - returns compressed length, or None if it would be larger than max_size
+    from glob import PSRAM
+
+    lit_v, lit_n, len_v, len_n, dist_v, dist_n = _zlib_tables()
+    window = 1 << ZLIB_WBITS
+
+    out = bytearray()
+    pos = 0
+
+    # BFINAL=1, BTYPE=01 (fixed Huffman)
+    acc = 0x3
+    nb = 3
+
+    buf = b''
+    i = 0
+    final = False
+    chunks = iter(chunks)
+
+    while not final:
+        try:
+            here = next(chunks)
+        except StopIteration:
+            final = True
+        else:
+            # keep just one window of history before next byte to encode
+            if i > window:
+                buf = buf[i-window:]
+                i = window
+            buf += bytes(here)
+
+        # hold back enough for longest possible match, unless at the end
+        n = len(buf)
+        limit = n if final else n - MAX_MATCH
+
+        while i < limit:
+            best = 0
+            top = min(MAX_MATCH, n - i)
+
+            if top >= 3:
+                lo = i - window if i > window else 0
+
+                # needle must start before i, but may run past it (overlapped copy)
+                j = buf.rfind(buf[i:i+3], lo, i+2)
+
+                if j >= 0:
+                    best, dist = 3, i - j
+                    bad = top + 1
+
+                    # double needle size until no match, then bisect to longest
+                    while best < top:
+                        ln = min(best * 2, top)
+                        j = buf.rfind(buf[i:i+ln], lo, i+ln-1)
+                        if j < 0:
+                            bad = ln
+                            break
+                        best, dist = ln, i - j
+
+                    while bad - best > 1:
+                        ln = (best + bad) // 2
+                        j = buf.rfind(buf[i:i+ln], lo, i+ln-1)
+                        if j < 0:
+                            bad = ln
+                        else:
+                            best, dist = ln, i - j
+
+            if best:
+                acc |= len_v[best] << nb
+                nb += len_n[best]
+                while nb >= 8:
+                    out.append(acc & 0xff)
+                    acc >>= 8
+                    nb -= 8
+
+                acc |= dist_v[dist] << nb
+                nb += dist_n[dist]
+                i += best
+            else:
+                b = buf[i]
+                acc |= lit_v[b] << nb
+                nb += lit_n[b]
+                i += 1
+
+            while nb >= 8:
+                out.append(acc & 0xff)
+                acc >>= 8
+                nb -= 8
+
+        # aligned writes
+        ln = len(out) & ~3
+        if pos + ln > max_size:
+            return None
+        if ln >= 1024 or final:
+            PSRAM.write_at(offset+pos, ln)[:] = out[0:ln]
+            out = out[ln:]
+            pos += ln
+
+    # end of block: symbol 256 is seven zero bits; then final partial byte
+    nb += 7
+    while nb > 0:
+        out.append(acc & 0xff)
+        acc >>= 8
+        nb -= 8
+
+    zlen = pos + len(out)
+    if zlen > max_size:
+        return None
+
+    if out:
+        # write final bit, perhaps some extra zeros after that too
+        pad = 4 - (len(out) % 4)
+        if pad < 4:
+            out += bytes(pad)
+        PSRAM.write_at(offset+pos, len(out))[:] = out
+
+    return zlen
+
 
 
 class BBQrHeader:
@@ -169,6 +407,26 @@ class BBQrHeader:
         else:
             return 'Unknown: %s' % self.file_type
         
+
+class PartsBitmap:
+    # Which parts of a BBQr series we have: one bit per part, plus a count.
+    # - acts enough like a set for BBQrState and draw_bbqr_progress()
+
+    def __init__(self, num_parts=0):
+        self.bits = bytearray((num_parts + 7) // 8)
+        self.count = 0
+
+    def add(self, which):
+        mask = 1 << (which & 7)
+        if not (self.bits[which >> 3] & mask):
+            self.bits[which >> 3] |= mask
+            self.count += 1
+
+    def __contains__(self, which):
+        return bool(self.bits[which >> 3] & (1 << (which & 7)))
+
+    def __len__(self):
+        return self.count
             
 class BBQrState:
     def __init__(self, storage):
@@ -177,7 +435,7 @@ class BBQrState:
 
     def reset(self):
         self.hdr = None
-        self.parts = set()
+        self.parts = PartsBitmap()
         self.runt = None
         self.blksize = None
 
@@ -201,6 +459,7 @@ class BBQrState:
             self.reset()
             self.storage.reset()
             self.hdr = hdr
+            self.parts = PartsBitmap(hdr.num_parts)
 
         if hdr.which not in self.parts:
             # we've NOT YET seen this one
@@ -322,9 +581,11 @@ class BBQrPsramStorage(BBQrStorage):
 
     def __init__(self):
         super().__init__()
-        self.frags = dict()
         self.psr_offset = 0
 
+        # staging for read-modify-write of partial words
+        self.word = bytearray(4)
+
     def alloc_buf(self, upper_bound):
         # using first part of PSRAM
 
@@ -340,24 +601,27 @@ class BBQrPsramStorage(BBQrStorage):
         self.buf = True
 
     def write_pkt(self, offset, data):
-        # Save indicated data, but problems:
+        # Save indicated data, straight into PSRAM, but problems:
         # - writes to PSRAM must be 4-aligned
         # - due to base32 math, typically incoming data will not be aligned
-        # - write what we can, keep the rest around in normal memory
+        # - aligned middle is written directly from the decoded data
+        # - partial words at either end are merged w/ what is there already, so
+        #   neighbouring parts can arrive in any order
         from glob import PSRAM
 
         # our offset into PSRAM
         offset += self.psr_offset       # will be aligned
 
-        # some at the start might be unaligned
-        off = 4 - (offset % 4)
-        if off != 4:
-            # up to 3 bytes at start
-            self.frags[offset] = bytes(data[0:off])
-            assert 1 <= len(self.frags[offset]) < 4
+        data = memoryview(data)
+
+        # some at the start might be unaligned: up to 3 bytes
+        off = offset % 4
+        if off:
+            ln = min(4 - off, len(data))
+            self.merge_word(offset - off, off, data[0:ln])
 
-            offset += off
-            data = memoryview(data)[off:]
+            offset += ln
+            data = data[ln:]
 
         ln = len(data)
         ln4 = ln & ~3
@@ -367,25 +631,17 @@ class BBQrPsramStorage(BBQrStorage):
             PSRAM.write_at(offset, ln4)[:] = data[0:ln4]
 
         # maybe a part at end
-        runt = ln - ln4
-        if runt:
-            assert 1 <= runt < 4
-            p = bytes(data[ln4:])
-            self.frags[offset+ln4] = p
-            assert 1 <= len(p) == runt < 4
+        if ln > ln4:
+            self.merge_word(offset + ln4, 0, data[ln4:])
 
-    def _finalize(self):
-        # flush out fragments to where they actually belong
+    def merge_word(self, off4, pos, data):
+        # read-modify-write of the aligned word at off4, placing data at pos within it
         from glob import PSRAM
 
-        while self.frags:
-            off, data = self.frags.popitem()
-
-            off4 = off & ~3         # can be aligned already (1-3 byte runt)
-            tmp = bytearray(PSRAM.read_at(off4, 4))
-            tmp[off-off4:off-off4+len(data)] = data
-            assert len(tmp) == 4
-            PSRAM.write_at(off4, 4)[:] = tmp
+        word = self.word
+        word[:] = PSRAM.read_at(off4, 4)
+        word[pos:pos+len(data)] = data
+        PSRAM.write_at(off4, 4)[:] = word
 
     def zlib_decompress(self):
         # do in-place Zlib decompression, update final_size
@@ -398,42 +654,45 @@ class BBQrPsramStorage(BBQrStorage):
 
         dis.fullscreen('Decompressing...')
 
+        # decode into fixed staging buffer; any unaligned tail is kept at its start
+        stage = bytearray(1024)
+        mv = memoryview(stage)
+
         off = 0
-        buf = b''
+        held = 0
         with BytesIO(PSRAM.read_at(self.psr_offset, self.final_size)) as fd:
             decoded = DecompIO(fd, -10)
             while 1:
                 try:
-                    here = decoded.read(1024)
+                    here = decoded.readinto(mv[held:])
                     if not here: break
                 except:
                     # corrupt data / data underruns trigger here
                     raise RuntimeError("Zlib fail")
 
                 # aligned writes
-                buf += here
-                ln = len(buf) & ~3
+                held += here
+                ln = held & ~3
 
                 if off+ln > MAX_TXN_LEN_MK4:
                     # test with: `yes | dd bs=1000 count=2700 | bbqr make - | pbcopy`
                     raise QRDecodeExplained("Too big")
                 
                 if ln:
-                    PSRAM.write_at(off, ln)[:] = buf[0:ln]
-                    buf = buf[ln:]
+                    PSRAM.write_at(off, ln)[:] = mv[0:ln]
+                    held -= ln
+                    stage[0:held] = mv[ln:ln+held]
                     off += ln
 
                 dis.progress_sofar(fd.tell(), self.final_size)
 
             # true final size
-            self.final_size = off + len(buf)
-
-            if buf:
-                # write final bit, perhaps some extra zeros after that too
-                pad = 4 - (len(buf) % 4)
-                if pad < 4:
-                    buf += bytes(pad)
-                PSRAM.write_at(off, len(buf))[:] = buf
+            self.final_size = off + held
+
+            if held:
+                # write final bit, plus some extra zeros after that too
+                stage[held:4] = bytes(4 - held)
+                PSRAM.write_at(off, 4)[:] = mv[0:4]
 
     def get_buffer(self):
         # give a pointer into PSRAM
@@ -14,6 +14,12 @@ from ustruct import unpack, pack, calcsize
 from ucollections import namedtuple
 from uhashlib import sha256
 from uio import BytesIO
+
+# AES work is done this many bytes at a time (multiple of 16)
+CHUNK_SIZE = 1024
+
+# FileHeader + SectionHeader, which start the file
+HEADERS_SIZE = 32
         
 def masked_crc(bits):
     return crc32(bits) & 0xffffffff
@@ -224,12 +230,14 @@ class Builder(object):
             self.key = self.calculate_key(password, progress_fcn)
 
         self.unpacked_size = 0
-        self.body = b''
+        self.body = bytearray()
         self.body_len = 0
         self.aes = None
         self.pt_crc = 0         # == crc32('')
         self.ct_crc = 0         # == crc32('')
         self.padding = None
+        self.pending = bytearray()      # partial block, not yet encrypted
+        self.out = None                 # when streaming: file-like for the body
 
     @classmethod
     def from_external(cls, **kws):
@@ -248,36 +256,50 @@ class Builder(object):
     def read_file(self, fd, password, max_size, progress_fcn=None):
         # read a file we wrote; unlikely to work on anything else.
         # assuming single file contained inside
+        # - fd must be seekable: body is read after the header that follows it
+        # - decrypted a chunk at a time, into buffer of final size; returns bytearray
         fhdr = FileHeader.read(fd)
         assert fhdr.has_good_magic()
 
-        for shdr, meta, body in SectionHeader.read_iter(fd):
-            # read out salt data, fname, sizes
-            fname, body_size, unpacked_size, expect_crc = self.parse_section_hdr(meta)
+        shdr = SectionHeader.read(fd)
+        assert shdr                 # read past end
 
-            assert len(body) == body_size
-            assert unpacked_size <= max_size, 'too big'
-            assert len(body) <= unpacked_size+16, 'too big, encoded'
-            assert len(body) % 16 == 0, 'not blocked'
+        body_pos = fd.tell()
+        fd.seek(shdr.offset, 1)
+        meta = fd.read(shdr.size)
+
+        # read out salt data, fname, sizes
+        fname, body_size, unpacked_size, expect_crc = self.parse_section_hdr(meta)
 
-            # figure out key to be used
-            key = self.calculate_key(password, progress_fcn)
+        assert body_size == shdr.offset
+        assert unpacked_size <= max_size, 'too big'
+        assert body_size <= unpacked_size+16, 'too big, encoded'
+        assert body_size % 16 == 0, 'not blocked'
 
-            aes = ngu.aes.CBC(False, key, self.iv)
+        # figure out key to be used
+        key = self.calculate_key(password, progress_fcn)
 
-            out = b''
-            for blk in range(0, len(body), 16):
-                out += aes.cipher(body[blk:blk+16])
+        aes = ngu.aes.CBC(False, key, self.iv)
 
-            aes.blank()
+        out = bytearray(unpacked_size)
+        crc = 0
+        fd.seek(body_pos)
+        for pos in range(0, body_size, CHUNK_SIZE):
+            here = fd.read(min(CHUNK_SIZE, body_size - pos))
+            assert len(here) % 16 == 0, 'truncated'
 
-            # trim padding, check CRC
-            out = out[0:unpacked_size]
-            if masked_crc(out) != expect_crc:
-                raise ValueError("Wrong password given, or damaged file.")
+            # trim padding, running CRC
+            pt = memoryview(aes.cipher(here))[0:max(0, unpacked_size - pos)]
+            out[pos:pos+len(pt)] = pt
+            crc = crc32(pt, crc)
 
-            # done. return contents
-            return fname, out
+        aes.blank()
+
+        if (crc & 0xffffffff) != expect_crc:
+            raise ValueError("Wrong password given, or damaged file.")
+
+        # done. return contents
+        return fname, out
             
     def verify_file_crc(self, fd, max_size, expected_sections=3):
         # Read each section, and check CRC of headers, return list of files & sizes.
@@ -306,24 +328,91 @@ class Builder(object):
         return files
 
     def add_data(self, raw):
+        # Encrypt more data. Any partial block is held until more data, or save()
         if not self.aes:
             # do this late, so easier to test w/ known values.
             self.aes = ngu.aes.CBC(True, self.key, self.iv)
 
+        assert self.padding is None         # "can't add more after save"
+
         here = len(raw)
         self.pt_crc = crc32(raw, self.pt_crc)
-
-        padded_len = (here + 15) & ~15
-        if padded_len != here:
-            if self.padding != None:
-                raise ValueError()          # "can't do less than a block except at end"
-            self.padding =  (padded_len - here)
-            raw += bytes(self.padding)
         self.unpacked_size += here
 
-        assert len(raw) % 16 == 0
-        self.body += self.aes.cipher(raw)
+        raw = memoryview(raw)
+        if self.pending:
+            # complete block held from last time
+            take = 16 - len(self.pending)
+            self.pending.extend(raw[0:take])
+            raw = raw[take:]
+            if len(self.pending) < 16:
+                return
+            self.add_body(self.aes.cipher(self.pending))
+            self.pending = bytearray()
+
+        whole = len(raw) & ~15
+        for pos in range(0, whole, CHUNK_SIZE):
+            self.add_body(self.aes.cipher(raw[pos:min(pos+CHUNK_SIZE, whole)]))
+
+        self.pending.extend(raw[whole:])
+
+    def write(self, raw):
+        # file-like interface for add_data(); text is saved as UTF-8
+        if isinstance(raw, str):
+            raw = raw.encode()
+        self.add_data(raw)
+        return len(raw)
+
+    def add_body(self, ct):
+        # collect ciphertext; when streaming, write it out a chunk at a time
+        # - body is a bytearray, so appends are in-place
+        self.body += ct
+        self.body_len += len(ct)
+
+        if self.out and len(self.body) >= CHUNK_SIZE:
+            self.out.write(self.body)
+            self.body = bytearray()
+
+    def finish_data(self):
+        # zero-pad the final partial block, if any
+        if self.padding is not None:
+            return
+
+        self.padding = (16 - len(self.pending)) % 16
+        if self.padding:
+            self.pending.extend(bytes(self.padding))
+            self.add_body(self.aes.cipher(self.pending))
+            self.pending = bytearray()
+
+        if self.out and self.body:
+            self.out.write(self.body)
+            self.body = bytearray()
 
+    def stream_start(self, fd):
+        # Encrypt directly into fd, instead of holding whole body in memory.
+        # - space for the headers is reserved now; see stream_finish()
+        # - same key/salt/iv can be used again, for another copy
+        self.aes = None
+        self.unpacked_size = 0
+        self.body = bytearray()
+        self.body_len = 0
+        self.pt_crc = 0
+        self.padding = None
+        self.pending = bytearray()
+        self.out = fd
+
+        fd.write(bytes(HEADERS_SIZE))
+
+    def stream_finish(self, fname='backup.txt'):
+        # Flush the body, write the footer. Returns headers which
+        # caller must write at very start of file.
+        hdr, footer = self.save(fname)
+        assert len(hdr) == HEADERS_SIZE
+
+        self.out.write(footer)
+        self.out = None
+
+        return hdr
 
     def calculate_key(self, password, progress_fcn=None):
         # do the expected key-derivation
@@ -493,6 +582,9 @@ class Builder(object):
     def save(self, fname='backup.txt'):
         # Render two final 7z file parts: the header and footer.
         # Caller must put self.body inbetween them.
+        if self.aes:
+            self.finish_data()
+
         sh = self.render_hdr(fname)
         sect = SectionHeader(size=len(sh),
                                 offset=self.body_len,
@@ -31,6 +31,13 @@ MAX_SATS = const(2100000000000000)
 # too many refusals will cause reset
 ABSOLUTE_MAX_REFUSALS = const(100)
 
+# audit log: bytes buffered before a write, delay before buffered entries
+# are written anyway, idle time before card released, and max log file size
+LOG_BUF_SIZE = const(4096)
+LOG_FLUSH_TIME = const(2000)
+LOG_IDLE_TIME = const(30000)
+LOG_MAX_FILE_SIZE = const(1024*1024)
+
 # you have this many seconds after boot to escape HSM
 # mode, if you enable the boot_to_hsm feature
 BOOT_LOCKOUT_TIME = const(60)
@@ -216,6 +223,7 @@ class ApprovalRule:
         self.max_amount = pop_int(j, 'max_amount', 0, MAX_SATS)
         self.users = pop_list(j, 'users', check_user)
         self.whitelist = pop_list(j, 'whitelist', cleanup_whitelist_value)
+        self.whitelist_set = frozenset(self.whitelist)      # for lookups; list kept for order
         self.whitelist_opts = pop_dict(j, 'whitelist_opts', False, WhitelistOpts)
         self.min_users = pop_int(j, 'min_users', 1, len(self.users))
         self.local_conf = pop_bool(j, 'local_conf')
@@ -322,8 +330,12 @@ class ApprovalRule:
 
         return rv
 
-    def matches_transaction(self, psbt, users, total_out, local_oked, chain):
+    def matches_transaction(self, psbt, users, total_out, local_oked, chain, outs=None):
         # Does this rule apply to this PSBT file? 
+        # - outs: PSBTOutputCache shared by all rules being tried
+        if outs is None:
+            outs = PSBTOutputCache(psbt, chain)
+
         if self.wallet:
             # rule limited to one wallet
             if psbt.active_multisig:
@@ -341,37 +353,15 @@ class ApprovalRule:
 
         # check all destinations are in the whitelist if mode is basic
         if self.whitelist and not attest_mode:
-            dests = set()
-            for idx, txo in psbt.output_iter():
-                o = psbt.outputs[idx]
-                if o.is_change or (txo.nValue == 0 and allow_zeroval):
-                    continue
-
-                try:
-                    address = chain.render_address(txo.scriptPubKey)
-                except ValueError:
-                    address = str(b2a_hex(txo.scriptPubKey), 'ascii')
-
-                dests.add(address)
-
-            diff = dests - set(self.whitelist)
-            assert not diff, "non-whitelisted address: " + diff.pop()
+            for address in outs.dests(allow_zeroval):
+                assert address in self.whitelist_set, "non-whitelisted address: " + address
 
         # check all foreign outputs are attested if mode is attest
         if self.whitelist and attest_mode:
-            for idx, txo in psbt.output_iter():
-                o = psbt.outputs[idx]
-                if o.is_change or (txo.nValue == 0 and allow_zeroval):
-                    continue
-                assert o.attestation, "missing attestation for output %i" % idx
-                # we are verifying the whole consensus-encoded txout
-                txo_bytes = CTxOut(txo.nValue, txo.scriptPubKey).serialize()
-                digest = chain.hash_message(txo_bytes)
-                addr_fmt, pubkey = chains.verify_recover_pubkey(o.attestation, digest)
+            for idx, ver_addr in outs.attested(allow_zeroval):
                 # we have extracted a valid pubkey from the sig, but is it
                 # a whitelisted pubkey or something else?
-                ver_addr = chain.pubkey_to_address(pubkey, addr_fmt)
-                assert ver_addr in self.whitelist, 'non-whitelisted attestation key for output %i' % idx
+                assert ver_addr in self.whitelist_set, 'non-whitelisted attestation key for output %i' % idx
 
         if self.local_conf:
             # local user must approve
@@ -417,30 +407,231 @@ class ApprovalRule:
 
         return True
 
-class AuditLogger:
-    def __init__(self, dirname, digest, never_log):
-        self.dirname = dirname
-        self.digest = digest
-        self.never_log = never_log
+class PSBTOutputCache:
+    # Per-PSBT work on the outputs, done once and shared by all rules tried.
+    # - rendered destination address of each foreign output
+    # - address of key that made each output's attestation (or why it failed)
+
+    def __init__(self, psbt, chain):
+        self.psbt = psbt
+        self.chain = chain
+        self.addrs = {}         # output idx => address
+        self.attests = {}       # output idx => (address, problem)
+
+    def foreign_outputs(self, allow_zeroval):
+        for idx, txo in self.psbt.output_iter():
+            o = self.psbt.outputs[idx]
+            if o.is_change or (txo.nValue == 0 and allow_zeroval):
+                continue
+            yield idx, txo
+
+    def dests(self, allow_zeroval):
+        # set of addresses we're sending to
+        rv = set()
+        for idx, txo in self.foreign_outputs(allow_zeroval):
+            address = self.addrs.get(idx)
+            if address is None:
+                try:
+                    address = self.chain.render_address(txo.scriptPubKey)
+                except ValueError:
+                    address = str(b2a_hex(txo.scriptPubKey), 'ascii')
 
-    def __enter__(self):
+                self.addrs[idx] = address
+
+            rv.add(address)
+
+        return rv
+
+    def attested(self, allow_zeroval):
+        # yield (idx, address) of key that signed each output; raise on first problem
+        for idx, txo in self.foreign_outputs(allow_zeroval):
+            if idx not in self.attests:
+                try:
+                    self.attests[idx] = (self.recover_attester(idx, txo), None)
+                except Exception as exc:
+                    self.attests[idx] = (None, str(exc) or problem_file_line(exc))
+
+            ver_addr, problem = self.attests[idx]
+            assert not problem, problem
+
+            yield idx, ver_addr
+
+    def recover_attester(self, idx, txo):
+        o = self.psbt.outputs[idx]
+        assert o.attestation, "missing attestation for output %i" % idx
+
+        # we are verifying the whole consensus-encoded txout
+        txo_bytes = CTxOut(txo.nValue, txo.scriptPubKey).serialize()
+        digest = self.chain.hash_message(txo_bytes)
+        addr_fmt, pubkey = chains.verify_recover_pubkey(o.attestation, digest)
+
+        return self.chain.pubkey_to_address(pubkey, addr_fmt)
+
+class AuditLogWriter:
+    # Keeps the SD card mounted and one log file open per directory, while
+    # log entries are arriving, and batches the writes.
+    # - entries are buffered in RAM, up to LOG_BUF_SIZE, then written
+    # - also written by timer, LOG_FLUSH_TIME after being queued
+    # - card released after LOG_IDLE_TIME with nothing to write
+    # - files rotated by size: no reliable date/time on this device
+    # - HSM mode blocks all other SD card access, so holding it mounted is safe
+    def __init__(self):
+        self.card = None
+        self.files = {}         # dirname => [fd, seq, size]
+        self.pending = []       # of (dirname, text)
+        self.pending_len = 0
+        self.last_write = 0
+        self.task = None
+
+    def ready(self):
+        # mount card if needed; False if we cannot save anything
         try:
-            if self.never_log:
-                raise NotImplementedError
+            self.mount()
+            return True
+        except (CardMissingError, OSError):
+            self.release()
+            return False
+
+    def mount(self):
+        if self.card and not CardSlot.is_inserted():
+            # card was pulled, any open files are gone
+            self.release()
 
+        if not self.card:
             self.card = CardSlot().__enter__()
 
-            d = self.card.get_sd_root() + '/' + self.dirname
+    def release(self):
+        # close files and unmount card, ignoring errors (card may be gone)
+        for fd, _, _ in self.files.values():
+            try: fd.close()
+            except: pass
+        self.files.clear()
+
+        if self.card:
+            try: self.card.__exit__(None, None, None)
+            except: pass
+            self.card = None
 
-            # mkdir if needed
+    def open_file(self, dirname, need):
+        # find (or rotate to) file for this directory with room for more
+        ent = self.files.get(dirname)
+        if ent and ent[2] + need <= LOG_MAX_FILE_SIZE:
+            return ent
+
+        d = self.card.get_sd_root() + '/' + dirname
+
+        if ent:
+            ent[0].close()
+            seq = ent[1] + 1
+        else:
+            # mkdir if needed, and continue with most recent file
             try: uos.stat(d)
             except: uos.mkdir(d)
-                
-            self.fname = d + '/' + b2a_hex(self.digest[-8:]).decode('ascii') + '.log'
-            self.fd = open(self.fname, 'a+t')       # append mode
-        except (CardMissingError, OSError, NotImplementedError):
+
+            seq = 0
+            for fn, *_ in uos.ilistdir(d):
+                if fn.startswith('audit-') and fn.endswith('.log'):
+                    try: seq = max(seq, int(fn[6:-4]))
+                    except ValueError: pass
+
+        while 1:
+            fname = d + '/audit-%04d.log' % seq
+            try:
+                size = uos.stat(fname)[6]
+            except OSError:
+                size = 0
+
+            if not size or size + need <= LOG_MAX_FILE_SIZE:
+                break
+            seq += 1
+
+        ent = [open(fname, 'a+t'), seq, size]      # append mode
+        self.files[dirname] = ent
+
+        return ent
+
+    def add(self, dirname, text):
+        # queue up an entry; write it soon
+        self.pending.append((dirname, text))
+        self.pending_len += len(text)
+
+        if self.pending_len >= LOG_BUF_SIZE:
+            self.flush()
+        else:
+            self.start_timer()
+
+    def flush(self):
+        # write all pending entries to card; False if they didn't make it
+        if not self.pending:
+            return True
+
+        try:
+            self.mount()
+
+            for dirname, text in self.pending:
+                ent = self.open_file(dirname, len(text))
+                ent[0].write(text)
+                ent[2] += len(text)
+
+            for fd, _, _ in self.files.values():
+                fd.flush()
+
+            ok = True
+        except (CardMissingError, OSError) as exc:
+            # may be fatal or not, depending on configuration; keep a copy on console
+            sys.print_exception(exc)
+            for _, text in self.pending:
+                sys.stdout.write(text)
+
+            self.release()
+            ok = False
+
+        self.pending.clear()
+        self.pending_len = 0
+        self.last_write = utime.ticks_ms()
+        self.start_timer()
+
+        return ok
+
+    def start_timer(self):
+        if self.task or not (self.pending or self.card):
+            return
+
+        import uasyncio
+        self.task = uasyncio.create_task(self.idle_task())
+
+    async def idle_task(self):
+        # write any stragglers, then release card once quiet
+        from uasyncio import sleep_ms
+
+        try:
+            while self.pending or self.card:
+                await sleep_ms(LOG_FLUSH_TIME)
+
+                if self.pending:
+                    self.flush()
+                elif utime.ticks_diff(utime.ticks_ms(), self.last_write) >= LOG_IDLE_TIME:
+                    self.release()
+        finally:
+            self.task = None
+
+AUDIT_LOG = AuditLogWriter()
+
+class AuditLogger:
+    # One request's worth of log entries, collected and then handed to AUDIT_LOG
+    def __init__(self, dirname, digest, never_log):
+        self.dirname = dirname
+        self.digest = digest
+        self.never_log = never_log
+
+    def __enter__(self):
+        if not self.never_log and AUDIT_LOG.ready():
+            self.saved = True
+            self.fd = uio.StringIO()
+            self.info('-- %s %s --' % (self.dirname, b2a_hex(self.digest).decode('ascii')))
+        else:
             # may be fatal or not, depending on configuration
-            self.fname = self.card = None
+            self.saved = False
             self.fd = sys.stdout
 
         return self
@@ -452,14 +643,26 @@ class AuditLogger:
 
         self.fd.write('\n===\n\n')
 
-        if self.card:
-            assert self.fd != sys.stdout
-            self.fd.close()
-            self.card.__exit__(exc_type, exc_value, traceback)
+        if self.saved:
+            AUDIT_LOG.add(self.dirname, self.fd.getvalue())
 
     @property
     def is_unsaved(self):
-        return not self.card
+        return not self.saved
+
+    def flush(self):
+        # write everything so far to card now; False if that failed
+        if not self.saved:
+            return False
+
+        AUDIT_LOG.add(self.dirname, self.fd.getvalue())
+        self.fd = uio.StringIO()
+        self.saved = AUDIT_LOG.flush()
+
+        if not self.saved:
+            self.fd = sys.stdout
+
+        return self.saved
 
     def info(self, msg):
         print(msg, file=self.fd)
@@ -478,6 +681,9 @@ class HSMPolicy:
         self.start_time = 0
 
         # velocity limits
+        # - kept in RAM only: record_spend() is O(1) and no flash is written per approval
+        # - no clock survives a reboot, so a saved journal couldn't tell how much of
+        #   the period remains; boot_to_hsm instead assumes period fully spent
         self.period_started = 0
         self.period_spends = {}
 
@@ -798,7 +1004,8 @@ class HSMPolicy:
                 self.refuse(log, 'Message signing not enabled for that path')
                 return 'x'
 
-            self.approve(log, 'Message signing allowed')
+            if not self.approve(log, 'Message signing allowed'):
+                return 'x'
 
         return 'y'
 
@@ -923,9 +1130,10 @@ class HSMPolicy:
 
                 # Pick a rule to apply to this specific txn
                 reasons = []
+                outs = PSBTOutputCache(psbt, chain)
                 for rule in self.rules:
                     try:
-                        if rule.matches_transaction(psbt, users, total_out, local_ok, chain):
+                        if rule.matches_transaction(psbt, users, total_out, local_ok, chain, outs):
                             break
                     except BaseException as exc:
                         # let's not share these details, except for debug; since
@@ -944,7 +1152,8 @@ class HSMPolicy:
                         msg += ', and the local operator.' if msg else 'local operator'
 
                 # looks good, do it
-                self.approve(log, "Acceptable by rule #%d" % rule.index)
+                if not self.approve(log, "Acceptable by rule #%d" % rule.index):
+                    return 'x'
 
                 if rule.per_period is not None:
                     self.record_spend(rule, total_out)
@@ -971,9 +1180,17 @@ class HSMPolicy:
     def approve(self, log, msg):
         # when things fail
         log.info("\nAPPROVED: " + msg)
+
+        if self.must_log and not log.flush():
+            # log entries are buffered, so must be on the card before we sign
+            self.refuse(log, "Could not log details, and must_log is set")
+            return False
+
         self.approvals += 1
         self.last_refusal = None
 
+        return True
+
 
 def hsm_status_report():
     # Return a JSON-able object. Documented and external programs
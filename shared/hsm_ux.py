@@ -369,6 +369,9 @@ class hsmUxInteraction:
         # and when the "boot_to_hsm" feature is used and successfully unlock near
         # boottime.
         from actions import goto_top_menu
+        from hsm import AUDIT_LOG
+        AUDIT_LOG.flush()
+        AUDIT_LOG.release()
         glob.hsm_active = None
         goto_top_menu()
 
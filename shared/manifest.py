@@ -31,6 +31,7 @@ freeze_as_mpy('', [
 	'nvstore.py',
 	'opcodes.py',
 	'paper.py',
+	'perf.py',
 	'pincodes.py',
 	'psbt.py',
 	'pwsave.py',
@@ -15,7 +15,7 @@ from opcodes import OP_CHECKMULTISIG
 from exceptions import FatalPSBTIssue
 from glob import settings
 from charcodes import KEY_NFC, KEY_CANCEL, KEY_QR
-from wallet import WalletABC, MAX_BIP32_IDX
+from wallet import WalletABC, MAX_BIP32_IDX, ADDR_BATCH_SIZE
 
 # PSBT Xpub trust policies
 TRUST_VERIFY = const(0)
@@ -106,6 +106,72 @@ def make_redeem_script(M, nodes, subkey_idx):
 
     return b''.join(pubkeys)
 
+class CosignerCache:
+    # Parsed cosigner xpubs for one wallet, and their children on the /0 and /1 branches.
+    # - held by caller while working on one PSBT, so each pubkey checked in
+    #   validate_script() costs a single child derivation
+    def __init__(self, wallet):
+        self.wallet = wallet
+        self.nodes = {}             # xp_idx => node
+        self.branches = {}          # (xp_idx, branch) => node
+
+    def node(self, xp_idx):
+        # cosigner's xpub, parsed; do not modify
+        node = self.nodes.get(xp_idx)
+        if node is None:
+            xpub = self.wallet.xpubs[xp_idx][-1]
+            node = self.wallet.chain.deserialize_node(xpub, AF_P2SH); assert node
+            self.nodes[xp_idx] = node
+
+        return node
+
+    def branch(self, xp_idx, change_idx):
+        # cosigner's xpub + /{change_idx}; do not modify
+        key = (xp_idx, change_idx)
+        node = self.branches.get(key)
+        if node is None:
+            node = self.node(xp_idx).copy()
+            node.derive(change_idx, False)
+            self.branches[key] = node
+
+        return node
+
+    def child_pubkeys(self, xp_idx, change_idx, start_idx, count):
+        # pubkeys for a range of indexes on one branch of a cosigner
+        parent = self.branch(xp_idx, change_idx)
+
+        rv = []
+        for idx in range(start_idx, start_idx+count):
+            node = parent.copy()
+            node.derive(idx, False)
+            rv.append(node.pubkey())
+
+        return rv
+
+    def pubkey(self, xp_idx, path):
+        # derive pubkey of cosigner xp_idx, at path: returns (depth of xpub, pubkey)
+        # - pubkey is None if xpub isn't deep enough to represent indicated path
+        node = self.node(xp_idx)
+
+        dp = node.depth()
+        if not (0 <= dp <= len(path)):
+            return dp, None
+
+        tail = path[dp:]
+        for sp in tail:
+            assert not (sp & 0x80000000), 'hard deriv'
+
+        if len(tail) >= 2 and tail[0] <= 1:
+            # usual case: .../{change}/{idx} -- keep the change-branch node
+            node = self.branch(xp_idx, tail[0])
+            tail = tail[1:]
+
+        node = node.copy()
+        for sp in tail:
+            node.derive(sp, False)     # works in-place
+
+        return dp, node.pubkey()
+
 class MultisigWallet(WalletABC):
     # Capture the info we need to store long-term in order to participate in a
     # multisig wallet as a co-signer.
@@ -127,6 +193,10 @@ class MultisigWallet(WalletABC):
     # optional: user can short-circuit many checks (system wide, one power-cycle only)
     disable_checks = False
 
+    # in-memory index of stored wallets; see get_index()
+    _index_src = None
+    _index = None
+
     def __init__(self, name, m_of_n, xpubs, addr_fmt=AF_P2SH, chain_type='BTC'):
         self.storage_idx = -1
 
@@ -226,29 +296,76 @@ class MultisigWallet(WalletABC):
 
         return rv
 
+    @classmethod
+    def get_index(cls):
+        # Deserialized wallets, and lookup: (N, xor of XFPs) => [wallets]
+        # - built on first use after login, or any change to the stored list
+        # - same instances are returned to all callers, so don't modify them
+        #   unless you will commit()
+        lst = settings.get('multisig')
+
+        if cls._index is None or cls._index_src is not lst:
+            wallets = [cls.deserialize(rec, idx) for idx, rec in enumerate(lst or [])]
+            lookup = {}
+            for w in wallets:
+                key = (w.N, w.xfp_xor())
+                if key in lookup:
+                    lookup[key].append(w)
+                else:
+                    lookup[key] = [w]
+
+            cls._index = (wallets, lookup)
+            cls._index_src = lst
+
+        return cls._index
+
+    @classmethod
+    def invalidate_index(cls):
+        # stored list has changed (maybe in-place)
+        cls._index = cls._index_src = None
+
+    @classmethod
+    def lookup(cls, xfp_paths):
+        # wallets that might match these (xfp, *path) values, in storage order
+        # - duplicate XFP values can't be handled by the index, so check everything
+        wallets, lookup = cls.get_index()
+
+        x = 0
+        xfps = set()
+        for xp in xfp_paths:
+            x ^= xp[0]
+            xfps.add(xp[0])
+
+        if len(xfps) != len(xfp_paths):
+            return wallets
+
+        return lookup.get((len(xfp_paths), x), ())
+
     @classmethod
     def iter_wallets(cls, M=None, N=None, not_idx=None, addr_fmt=None):
         # yield MS wallets we know about, that match at least right M,N if known.
         # - this is only place we should be searching this list, please!!
-        lst = settings.get('multisig', [])
+        wallets, _ = cls.get_index()
 
-        for idx, rec in enumerate(lst):
-            if idx == not_idx:
+        for rv in wallets:
+            if rv.storage_idx == not_idx:
                 # ignore one by index
                 continue
 
             if M or N:
-                # peek at M/N
-                has_m, has_n = tuple(rec[1])
-                if M is not None and has_m != M: continue
-                if N is not None and has_n != N: continue
-
-            if addr_fmt is not None:
-                opts = rec[3]
-                af = opts.get('ft', AF_P2SH)
-                if af != addr_fmt: continue
-                
-            yield cls.deserialize(rec, idx)
+                if M is not None and rv.M != M: continue
+                if N is not None and rv.N != N: continue
+
+            if addr_fmt is not None and rv.addr_fmt != addr_fmt: continue
+
+            yield rv
+
+    def xfp_xor(self):
+        # all XFP values xor-ed together: cheap wallet lookup key
+        x = 0
+        for xfp in self.xfp_paths.keys():
+            x ^= xfp
+        return x
 
     def get_xfp_paths(self):
         # return list of lists [xfp, *deriv]
@@ -260,7 +377,10 @@ class MultisigWallet(WalletABC):
         # - xfp_paths is list of lists: [xfp, *path] like in psbt files
         # - M and N must be known
         # - returns instance, or None if not found
-        for rv in cls.iter_wallets(M, N, addr_fmt=addr_fmt):
+        for rv in cls.lookup(xfp_paths):
+            if (rv.M, rv.N) != (M, N): continue
+            if addr_fmt is not None and rv.addr_fmt != addr_fmt: continue
+
             if rv.matching_subpaths(xfp_paths):
                 return rv
 
@@ -273,10 +393,11 @@ class MultisigWallet(WalletABC):
         # - returns set of matches, of any M value
 
         # we know N, but not M at this point.
-        N = len(xfp_paths)
-        
         matches = []
-        for rv in cls.iter_wallets(M=M, addr_fmt=addr_fmt):
+        for rv in cls.lookup(xfp_paths):
+            if M is not None and rv.M != M: continue
+            if addr_fmt is not None and rv.addr_fmt != addr_fmt: continue
+
             if rv.matching_subpaths(xfp_paths):
                 matches.append(rv)
 
@@ -320,16 +441,9 @@ class MultisigWallet(WalletABC):
     @classmethod
     def quick_check(cls, M, N, xfp_xor):
         # quicker? USB method.
-        rv = []
-        for ms in cls.iter_wallets(M, N):
-            x = 0
-            for xfp in ms.xfp_paths.keys():
-                x ^= xfp
-            if x != xfp_xor: continue
-
-            return True
+        _, lookup = cls.get_index()
 
-        return False
+        return any(ms.M == M for ms in lookup.get((N, xfp_xor), ()))
 
     @classmethod
     def get_all(cls):
@@ -344,14 +458,12 @@ class MultisigWallet(WalletABC):
     @classmethod
     def get_by_idx(cls, nth):
         # instance from index number (used in menu)
-        lst = settings.get('multisig', [])
+        wallets, _ = cls.get_index()
         try:
-            obj = lst[nth]
+            return wallets[nth]
         except IndexError:
             return None
 
-        return cls.deserialize(obj, nth)
-
     def commit(self):
         # data to save
         # - important that this fails immediately when nvram overflows
@@ -368,6 +480,7 @@ class MultisigWallet(WalletABC):
             v[self.storage_idx] = obj
 
         settings.set('multisig', v)
+        self.invalidate_index()
 
         # save now, rather than in background, so we can recover
         # from out-of-space situation
@@ -439,6 +552,7 @@ class MultisigWallet(WalletABC):
             settings.set('multisig', lst)
         else:
             settings.remove_key('multisig')
+        self.invalidate_index()
         settings.save()
 
         self.storage_idx = -1
@@ -451,36 +565,65 @@ class MultisigWallet(WalletABC):
     def yield_addresses(self, start_idx, count, change_idx=0):
         # Assuming a suffix of /0/0 on the defined prefix's, yield
         # possible deposit addresses for this wallet.
+        # - indicate path used (for UX) for each cosigner
+        paths = ["[%s/%s/%d/" % (xfp2str(xfp), deriv[2:], change_idx)
+                    for xfp, deriv, _ in self.xpubs]
+
+        for batch in self.address_batches(start_idx, count, change_idx):
+            for idx, addr, script in batch:
+                tail = '%d]' % idx
+                yield idx, addr, [p + tail for p in paths], script
+
+    def address_batches(self, start_idx, count, change_idx=0):
+        # Make addresses a batch at a time: yields list of (idx, addr, redeem script)
+        # - same list is reused for next batch, so consume before asking for more
+        # - each cosigner derives pubkeys for whole batch, from cached branch node
+        # - redeem script is built into a template; always applies BIP-67 sorting
         ch = self.chain
+        M, N = self.M, self.N
 
         assert self.addr_fmt, 'no addr fmt known'
+        assert 1 <= M <= N <= MAX_SIGNERS
 
-        # setup
-        nodes = []
-        paths = []
-        for xfp, deriv, xpub in self.xpubs:
-            # load bip32 node for each cosigner
-            node = ch.deserialize_node(xpub, AF_P2SH)
-            node.derive(change_idx, False)
-            # indicate path used (for UX)
-            path = "[%s/%s/%d/{idx}]" % (xfp2str(xfp), deriv[2:], change_idx)
-            nodes.append(node)
-            paths.append(path)
-
-        idx = start_idx
-        while count:
-            if idx > MAX_BIP32_IDX:
-                break
-            # make the redeem script, convert into address
-            script = make_redeem_script(self.M, nodes, idx)
-            addr = ch.p2sh_address(self.addr_fmt, script)
+        cache = CosignerCache(self)
+
+        # OP_M (0x21=33=OP_PUSHDATA(33) pubkey)*N OP_N OP_CHECKMULTISIG
+        script = bytearray(1 + (34 * N) + 2)
+        script[0] = 80 + M
+        for i in range(N):
+            script[1 + (34 * i)] = 33
+        script[-2] = 80 + N
+        script[-1] = OP_CHECKMULTISIG
+
+        keys = [None] * N
+        batch = []
+
+        count = min(count, MAX_BIP32_IDX + 1 - start_idx)
+        while count > 0:
+            here = min(count, ADDR_BATCH_SIZE)
+            cols = [cache.child_pubkeys(i, change_idx, start_idx, here) for i in range(N)]
+
+            batch.clear()
+            for j in range(here):
+                for i in range(N):
+                    keys[i] = cols[i][j]
+                keys.sort()
+
+                pos = 2
+                for pk in keys:
+                    script[pos:pos+33] = pk
+                    pos += 34
 
-            yield idx, addr, [p.format(idx=idx) for p in paths], script
+                rs = bytes(script)
+                batch.append((start_idx + j, ch.p2sh_address(self.addr_fmt, rs), rs))
 
-            idx += 1
-            count -= 1
+            del cols
+            yield batch
 
-    def validate_script(self, redeem_script, subpaths=None, xfp_paths=None):
+            start_idx += here
+            count -= here
+
+    def validate_script(self, redeem_script, subpaths=None, xfp_paths=None, cache=None):
         # Check we can generate all pubkeys in the redeem script, raise on errors.
         # - working from pubkeys in the script, because duplicate XFP can happen
         # - if disable_checks is set better to handle in caller, but we're also neutered
@@ -488,16 +631,19 @@ class MultisigWallet(WalletABC):
         # redeem_script: what we expect and we were given
         # subpaths: pubkey => (xfp, *path)
         # xfp_paths: (xfp, *path) in same order as pubkeys in redeem script
+        # cache: CosignerCache for this wallet, if checking many scripts
 
         subpath_help = []
         used = set()
-        ch = self.chain
 
         M, N, pubkeys = disassemble_multisig(redeem_script)
         assert M==self.M and N == self.N, 'wrong M/N in script'
 
         if self.disable_checks: return ['UNVERIFIED']
 
+        if cache is None:
+            cache = CosignerCache(self)
+
         for pk_order, pubkey in enumerate(pubkeys):
             check_these = []
 
@@ -527,26 +673,17 @@ class MultisigWallet(WalletABC):
             too_shallow = False
             for xp_idx, path in check_these:
                 # matched fingerprint, try to make pubkey that needs to match
-                xpub = self.xpubs[xp_idx][-1]
-
-                node = ch.deserialize_node(xpub, AF_P2SH); assert node
-                dp = node.depth()
+                dp, found_pk = cache.pubkey(xp_idx, path)
 
                 #print("%s => deriv=%s dp=%d len(path)=%d path=%s" %
                 #        (xfp2str(xfp), self.xpubs[xp_idx][1], dp, len(path), path))
 
-                if not (0 <= dp <= len(path)):
+                if found_pk is None:
                     # obscure case: xpub isn't deep enough to represent
                     # indicated path... not wrong really.
                     too_shallow = True
                     continue
 
-                for sp in path[dp:]:
-                    assert not (sp & 0x80000000), 'hard deriv'
-                    node.derive(sp, False)     # works in-place
-
-                found_pk = node.pubkey()
-
                 # Document path(s) used. Not sure this is useful info to user tho.
                 # - Do not show what we can't verify: we don't really know the hardeneded
                 #   part of the path from fingerprint to here.
@@ -19,32 +19,51 @@ from exceptions import UnknownAddressExplained
 # - doesn't really have a gap limit concept, but limited to first N addresses in a wallet
 # - cannot be used to accelerate address explorer because we don't store full addresses
 # - data stored in binary, fixed-length header, then fixed-length records
+# - records are (hash, index) pairs, sorted, so lookup is a binary search
 # - multisig and single sig, and someday taproot, miniscript too
 # - searching leaves behind a cache for next time
 # - data building/saves happens when are searching, but might grab some during addr expl export?
+# - also built a little at a time in background, while sitting idle at top menu
 # - performance: 1m40s for one P2PKH wallet (change, and external addresses: 1528 in all)
 #
 
 # length of hashed & truncated address record
 HASH_ENC_LEN = const(2)
 
+# on-disk record: hashed address, then big-endian index; sorts as bytes
+OWNERSHIP_REC_LEN = const(4)        # = HASH_ENC_LEN + 2
+
 # File header
 OwnershipFileHdr = namedtuple('OwnershipFileHdr', 'file_magic change_idx flags')
 OWNERSHIP_FILE_HDR = 'HHI'
 OWNERSHIP_FILE_HDR_LEN = 8
 
-OWNERSHIP_MAGIC = 0x10A0            # "Address Ownership" v1.0
+OWNERSHIP_MAGIC_V1 = 0x10A0         # "Address Ownership" v1.0: just hashes, in index order
+OWNERSHIP_MAGIC = 0x10A1            # v1.1: sorted (hash, index) records
 # flags: none yet, but 32 bits reserved
 
-# target 3 flash blocks, max file size => 764 addresses
-MAX_ADDRS_STORED = const(764)       # =((3*512) - OWNERSHIP_FILE_HDR_LEN) // HASH_ENC_LEN
+# v1.1 files take up to 6 flash blocks, since each record also holds its index:
+# ((6*512) - OWNERSHIP_FILE_HDR_LEN) // OWNERSHIP_REC_LEN = 766 would fit, but the
+# limit stays at 764 (the v1.0 value) so upgraded v1.0 files cover the same range
+MAX_ADDRS_STORED = const(764)
 BONUS_GAP_LIMIT = const(20)
 
+# background building: addresses per file rewrite, and how idle we must be first
+BG_CHUNK_SIZE = const(100)
+BG_IDLE_TIME = const(15000)         # ms since last keypress
+BG_POLL_TIME = const(5000)          # ms
+BG_DONE_POLL_TIME = const(120000)   # ms, when all files complete; new wallets are rare
+
 def encode_addr(addr, salt):
     # Convert text address to something we can store while preserving privacy.
     return ngu.hash.sha256s(salt + addr)[0:HASH_ENC_LEN]
 
+def encode_record(hashed, idx):
+    return hashed + struct.pack('>H', idx)
+
 class AddressCacheFile:
+    # bumped on any file write, so background builder can tell it's been raced
+    writes = 0
 
     def __init__(self, wallet, change_idx):
         self.wallet = wallet
@@ -75,8 +94,12 @@ class AddressCacheFile:
                 assert len(hdr) == OWNERSHIP_FILE_HDR_LEN
                 flen = fd.seek(0, 2)
             self.hdr = OwnershipFileHdr(*struct.unpack(OWNERSHIP_FILE_HDR, hdr))
-            assert self.hdr.file_magic == OWNERSHIP_MAGIC
             assert self.hdr.change_idx == self.change_idx
+
+            if self.hdr.file_magic == OWNERSHIP_MAGIC_V1:
+                flen = self.upgrade_v1(flen)
+
+            assert self.hdr.file_magic == OWNERSHIP_MAGIC
         except OSError:
             return
         except Exception as exc:
@@ -85,55 +108,140 @@ class AddressCacheFile:
             self.hdr = None
             return
 
-        self.count = (flen - OWNERSHIP_FILE_HDR_LEN) // HASH_ENC_LEN
+        self.count = (flen - OWNERSHIP_FILE_HDR_LEN) // OWNERSHIP_REC_LEN
+
+    def upgrade_v1(self, flen):
+        # convert older file, which is just hashes in index order, to sorted records
+        # - rewritten in place; hints only, so worst case is rebuilding it later
+        count = (flen - OWNERSHIP_FILE_HDR_LEN) // HASH_ENC_LEN
+        with open(self.fname, 'rb') as fd:
+            fd.seek(OWNERSHIP_FILE_HDR_LEN)
+            buf = fd.read(count * HASH_ENC_LEN)
+
+        assert len(buf) == count * HASH_ENC_LEN
+
+        recs = [encode_record(buf[i*HASH_ENC_LEN:(i+1)*HASH_ENC_LEN], i) for i in range(count)]
+        del buf
+
+        self.hdr = OwnershipFileHdr(OWNERSHIP_MAGIC, self.change_idx, self.hdr.flags)
+        self.write_records(recs)
+
+        return OWNERSHIP_FILE_HDR_LEN + (count * OWNERSHIP_REC_LEN)
+
+    def read_records(self):
+        # all existing records, in file (sorted) order
+        if not self.count:
+            return []
+
+        with open(self.fname, 'rb') as fd:
+            fd.seek(OWNERSHIP_FILE_HDR_LEN)
+            buf = fd.read(self.count * OWNERSHIP_REC_LEN)
+
+        assert len(buf) == self.count * OWNERSHIP_REC_LEN
+
+        return [bytes(buf[i:i+OWNERSHIP_REC_LEN]) for i in range(0, len(buf), OWNERSHIP_REC_LEN)]
+
+    def write_records(self, recs):
+        # replace file contents w/ header and these records, sorted
+        recs.sort()
+        AddressCacheFile.writes += 1
+        with open(self.fname, 'wb') as fd:
+            fd.write(struct.pack(OWNERSHIP_FILE_HDR, *self.hdr))
+            for r in recs:
+                fd.write(r)
 
     def setup(self, change_idx, start_idx):
         assert self.change_idx == change_idx
 
         if self.count or self.hdr:
             assert start_idx == self.count, 'not an append'
-
-            # Open for append, header should be right already
-            self.fd = open(self.fname, 'ab')
         else:
             # Start new file
             assert start_idx == 0
-            self.fd = open(self.fname, 'wb')
             self.hdr = OwnershipFileHdr(OWNERSHIP_MAGIC, self.change_idx, 0x0)
-            hdr = struct.pack(OWNERSHIP_FILE_HDR, *self.hdr)
-            self.fd.write(hdr)
+
+        # new records collected in memory, and merged into file at end
+        self.pending = bytearray()
+        self.next_idx = start_idx
 
     def append(self, addr):
         if addr is None:
-            # close file, done
-            self.fd.close()
-            del self.fd
+            # merge into sorted records, rewrite file, done
+            recs = self.read_records()
+            p = self.pending
+            recs.extend(bytes(p[i:i+OWNERSHIP_REC_LEN]) for i in range(0, len(p), OWNERSHIP_REC_LEN))
+            del self.pending, p
+
+            self.write_records(recs)
+            self.count = len(recs)
             return
 
         assert '_' not in addr
-        self.fd.write(encode_addr(addr, self.salt))
+        if self.next_idx <= 0xffff:
+            # index must fit in record
+            self.pending.extend(encode_record(encode_addr(addr, self.salt), self.next_idx))
+        self.next_idx += 1
 
     def fast_search(self, addr):
         # Do the easy part of the searching, using the existing file's contents.
-        # - generates candidate path subcomponents; might be false positive
-        # - working in-memory, since complete file isn't very large, and speed
-        from glob import dis
-
+        # - returns candidate path subcomponents; might be false positive
+        # - binary search on sorted records, so only reads a few of them
         if not self.hdr or not self.count:
-            return
+            return []
+
+        chk = encode_addr(addr, self.salt)
+        rv = []
 
         with open(self.fname, 'rb') as fd:
-            fd.seek(OWNERSHIP_FILE_HDR_LEN)
-            buf = fd.read(self.count * HASH_ENC_LEN)
+            # find first record w/ hash >= chk
+            lo, hi = 0, self.count
+            while lo < hi:
+                mid = (lo + hi) // 2
+                fd.seek(OWNERSHIP_FILE_HDR_LEN + (mid * OWNERSHIP_REC_LEN))
+                if fd.read(HASH_ENC_LEN) < chk:
+                    lo = mid + 1
+                else:
+                    hi = mid
 
-        assert len(buf) == (self.count * HASH_ENC_LEN)
+            # collect all with same hash; usually zero or one
+            fd.seek(OWNERSHIP_FILE_HDR_LEN + (lo * OWNERSHIP_REC_LEN))
+            for _ in range(lo, self.count):
+                rec = fd.read(OWNERSHIP_REC_LEN)
+                if rec[0:HASH_ENC_LEN] != chk:
+                    break
+                idx, = struct.unpack('>H', rec[HASH_ENC_LEN:])
+                rv.append((self.change_idx, idx))
 
-        chk = encode_addr(addr, self.salt)
-        for idx in range(self.count):
-            if buf[idx*HASH_ENC_LEN : (idx*HASH_ENC_LEN)+HASH_ENC_LEN] == chk:
-                yield (self.change_idx, idx)
+        return rv
 
-            dis.progress_sofar(idx, self.count)
+    async def build_idle(self, count, still_idle):
+        # Add up to count addresses, yielding to other tasks between each one.
+        # - if still_idle() fails, or file changed under us, stop and save nothing
+        # - resumes from the count in the file, which is the cursor
+        from uasyncio import sleep_ms
+
+        b4 = AddressCacheFile.writes
+        start_idx = self.count
+        count = min(count, MAX_ADDRS_STORED - start_idx)
+        if count <= 0:
+            return
+
+        self.setup(self.change_idx, start_idx)
+
+        gen = self.wallet.yield_addresses(start_idx, count, change_idx=self.change_idx)
+        try:
+            for _,here,*_ in gen:
+                self.append(here)
+
+                await sleep_ms(1)
+                if not still_idle() or AddressCacheFile.writes != b4:
+                    del self.pending
+                    return
+        finally:
+            # release generator, and any nodes it holds, promptly
+            gen.close()
+
+        self.append(None)
 
     def check_match(self, want_addr, subpath):
         # need to double-check matches, to get rid of false positives.
@@ -166,7 +274,6 @@ class AddressCacheFile:
                 match = (self.change_idx, idx)
 
             self.append(here)
-            self.count += 1
             if match:
                 bonus += 1
 
@@ -201,6 +308,89 @@ class OwnershipCache:
 
         return file.append
 
+    @classmethod
+    def all_wallets(cls):
+        # Every wallet we'd consider during search, regardless of address type.
+        from multisig import MultisigWallet
+        from wallet import MasterSingleSigWallet
+        from public_constants import AF_CLASSIC, AF_P2WPKH, AF_P2WPKH_P2SH
+
+        rv = list(MultisigWallet.iter_wallets())
+
+        for af in (AF_P2WPKH, AF_CLASSIC, AF_P2WPKH_P2SH):
+            rv.append(MasterSingleSigWallet(af, account_idx=0))
+
+        for af, acct_num in settings.get('accts', []):
+            if acct_num:
+                rv.append(MasterSingleSigWallet(af, account_idx=acct_num))
+
+        return rv
+
+    @classmethod
+    def is_idle(cls):
+        # Is it a good time to do background work?
+        # - logged in w/ a secret, not HSM, at top menu, no recent keypress
+        import glob
+        from pincodes import pa
+        from ux import the_ux
+        import utime
+
+        if glob.hsm_active or pa.is_secret_blank():
+            return False
+
+        if len(the_ux.stack) != 1:
+            return False
+
+        last = glob.numpad.last_event_time
+        if last and utime.ticks_diff(utime.ticks_ms(), last) < BG_IDLE_TIME:
+            return False
+
+        return True
+
+    @classmethod
+    def next_to_build(cls, skip):
+        # find first incomplete file, if any
+        for w in cls.all_wallets():
+            for change_idx in (0, 1):
+                try:
+                    f = AddressCacheFile(w, change_idx)
+                except Exception:
+                    # some wallet we can't describe; search would fail too
+                    break
+
+                if f.count < MAX_ADDRS_STORED and f.fname not in skip:
+                    return f
+
+        return None
+
+    @classmethod
+    async def background_builder(cls):
+        # Long-running task: extend cache files while device is idle, so that
+        # a later search is a quick lookup, not minutes of address generation.
+        # - order of wallets and file lengths is enough to resume after reboot
+        from uasyncio import sleep_ms
+
+        skip = set()        # files that failed, don't retry until reboot
+        while 1:
+            await sleep_ms(BG_POLL_TIME)
+
+            f = None
+            try:
+                if not cls.is_idle():
+                    continue
+
+                f = cls.next_to_build(skip)
+                if not f:
+                    await sleep_ms(BG_DONE_POLL_TIME)
+                    continue
+
+                await f.build_idle(BG_CHUNK_SIZE, cls.is_idle)
+            except Exception as exc:
+                # never die; this is just an optimization
+                sys.print_exception(exc)
+                if f:
+                    skip.add(f.fname)
+
     @classmethod
     def search(cls, addr):
         # Find it!
@@ -384,6 +574,7 @@ class OwnershipCache:
     @classmethod
     def wipe_all(cls):
         # clear all cached addresses. will affect other seeds in vault
+        AddressCacheFile.writes += 1
         for fn in os.listdir():
             if fn.endswith('.own'):
                 os.remove(fn)
@@ -0,0 +1,63 @@
+# (c) Copyright 2024 by Coinkite Inc. This file is covered by license found in COPYING-CC.
+#
+# perf.py - timing of each phase of the PSBT approval flow
+#
+# - records elapsed ms, and change in gc.mem_free(), for each named phase
+# - only active in simulator and devmode builds; costs nothing otherwise
+# - read back over USB w/ 'PERF' test command (see usb_test_commands.py)
+#
+import utime, gc, ckcc, version
+
+class _NoPhase:
+    # stand-in when we aren't measuring
+    def __enter__(self):
+        return self
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        return False
+
+class _Phase:
+    def __init__(self, owner, name):
+        self.owner = owner
+        self.name = name
+
+    def __enter__(self):
+        self.mem = gc.mem_free()
+        self.t0 = utime.ticks_ms()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        dt = utime.ticks_diff(utime.ticks_ms(), self.t0)
+        self.owner.record(self.name, dt, gc.mem_free() - self.mem)
+        return False
+
+class PhaseTimer:
+    def __init__(self):
+        self.enabled = False
+        self.phases = []        # of (name, elapsed_ms, mem_free_delta)
+
+    def reset(self):
+        # start of a new transaction; devmode is only known after version.probe_system()
+        self.enabled = bool(ckcc.is_simulator() or version.is_devmode)
+        self.phases.clear()
+
+    def phase(self, name):
+        # use as context manager around a phase of work
+        return _Phase(self, name) if self.enabled else _NoPhase()
+
+    def record(self, name, elapsed_ms, mem_delta=None):
+        if self.enabled:
+            self.phases.append((name, elapsed_ms, mem_delta))
+
+    def stage_hook(self, name):
+        # callback for sub-stages reported elsewhere, like psbtObject.stage_hook
+        if not self.enabled:
+            return None
+        return lambda stage, ms: self.record(name + '.' + stage, ms)
+
+    def report(self):
+        # JSON-ready
+        return [dict(phase=n, ms=ms, mem=mem) for n, ms, mem in self.phases]
+
+PERF = PhaseTimer()
+
+# EOF
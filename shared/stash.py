@@ -173,6 +173,9 @@ class SensitiveValues:
     def __init__(self, secret=None, bip39pw='', bypass_tmp=False):
         self.spots = []
 
+        # path prefix => intermediate HDNode, see derive_path
+        self._prefix_cache = {}
+
         self._bip39pw = bip39pw
 
         if secret is not None:
@@ -286,6 +289,7 @@ class SensitiveValues:
 
         # just in case this holds some pointers?
         del self.spots
+        del self._prefix_cache
 
         # .. and some GC will help too!
         gc.collect()
@@ -327,11 +331,9 @@ class SensitiveValues:
 
     def derive_path(self, path, master=None, register=True):
         # Given a string path, derive the related subkey
-        rv = (master or self.node).copy()
-
-        if register:
-            self.register(rv)
-
+        # - when working from our master, parent nodes are cached (see _prefix_node)
+        #   so sibling paths only cost a single child derivation each
+        parts = []
         for i in path.split('/'):
             if i == 'm': continue
             if not i: continue      # trailing or duplicated slashes
@@ -345,10 +347,42 @@ class SensitiveValues:
                 is_hard = False
 
             assert 0 <= here < 0x80000000
+            parts.append((here, is_hard))
+
+        if master:
+            rv = master.copy()
+            todo = parts
+        elif parts:
+            rv = self._prefix_node(tuple(parts[:-1])).copy()
+            todo = parts[-1:]
+        else:
+            rv = self.node.copy()
+            todo = parts
+
+        if register:
+            self.register(rv)
+
+        for here, is_hard in todo:
             rv.derive(here, is_hard)
 
         return rv
 
+    def _prefix_node(self, prefix):
+        # Return (shared, do not modify) node for path prefix, which is a tuple
+        # of (index, is_hard). Derived once and kept until we are wiped on exit.
+        if not prefix:
+            return self.node
+
+        rv = self._prefix_cache.get(prefix)
+        if rv is None:
+            rv = self._prefix_node(prefix[:-1]).copy()
+            self.register(rv)
+
+            rv.derive(*prefix[-1])
+            self._prefix_cache[prefix] = rv
+
+        return rv
+
     def duress_root(self):
         # Return a bip32 node for the duress wallet linked to this wallet.
         # 0x80000000 - 0xCC10 = 2147431408
@@ -2,12 +2,12 @@
 #
 # usb.py - USB related things
 #
-import ckcc, pyb, callgate, sys, ux, ngu, stash, aes256ctr
+import ckcc, pyb, callgate, sys, ux, ngu, stash, aes256ctr, utime
 from uasyncio import sleep_ms, core
 from uhashlib import sha256
 from public_constants import MAX_MSG_LEN, MAX_BLK_LEN, AFC_SCRIPT
 from public_constants import STXN_FLAGS_MASK
-from ustruct import pack, unpack_from
+from ustruct import pack, unpack_from, calcsize
 from ckcc import watchpoint, is_simulator
 from utils import problem_file_line, call_later_ms
 from version import supports_hsm, is_devmode, MAX_TXN_LEN, MAX_UPLOAD_LEN
@@ -43,30 +43,30 @@ hid_descp = bytes([
             0xc0,              # END_COLLECTION
         ])
 
-# Only these whitelisted USB commands are allowed once we enter HSM mode.
-# NOTE: 'robo' here would allow firmware changes during HSM mode!
-HSM_WHITELIST = frozenset({
-    'logo', 'ping', 'vers',     # harmless/boring
-    'upld', 'sha2', 'dwld', 'stxn',     # up/download/sign PSBT needed
-    'mitm', 'ncry',             # maybe limited by policy tho
-    'smsg',                     # limited by policy
-    'blkc', 'hsts',             # report status values
-    'stok', 'smok',             # completion check: sign txn or msg
-    'xpub', 'msck',             # quick status checks
-    'p2sh', 'show',             # limited by HSM policy
-    'user',                     # auth HSM user, other user cmds not allowed
-    'gslr',                     # read storage locker; hsm mode only, limited usage
-})
-
-# HSM related commands that are not allowed if 'hsmcmd' is disabled.
-HSM_DISABLE_CMDS = frozenset({
-    "user",
-    "rmur",
-    "nwur",
-    "gslr",
-    "hsts",
-    "hsms",
-})
+# USB command table: 4-char command => (handler, arg struct, struct size, flags)
+# - filled by @usb_cmd on USBHandler methods, below
+# - handler gets the unpacked struct values, and then rest of args if CMD_TAIL
+USB_COMMANDS = {}
+
+# Command flags
+# - only CMD_HSM commands are allowed once we enter HSM mode
+# - NOTE: 'robo' in HSM mode would allow firmware changes!
+CMD_HSM = const(0x01)           # allowed during HSM mode (maybe limited by policy tho)
+CMD_HSMCMD = const(0x02)        # not allowed if 'hsmcmd' setting is disabled
+CMD_ENCRYPT = const(0x04)       # request must be encrypted
+CMD_TAIL = const(0x08)          # handler wants variable-length data after the struct
+CMD_MK4 = const(0x10)           # HSM and user-related: only if supports_hsm
+
+def usb_cmd(cmd, fmt=None, flags=0):
+    # register method as handler for a USB command
+    def decorator(fn):
+        assert cmd not in USB_COMMANDS, cmd
+        USB_COMMANDS[cmd] = (fn, fmt, calcsize(fmt) if fmt else 0, flags)
+        return fn
+    return decorator
+
+# min time between redraws of "Receiving..." during uploads
+PROGRESS_REDRAW_MS = const(250)
 
 # singleton instance of USBHandler()
 handler = None
@@ -132,8 +132,22 @@ class USBHandler:
         self.msg = bytearray(2048+12)
         assert len(self.msg) == MAX_MSG_LEN
 
+        # preallocated: one packet each way, and download responses
+        # - cannot reuse rx buffer for responses, but these are safe: a response
+        #   is fully sent before the next request is read
+        self.rx_pkt = bytearray(64)
+        self.tx_pkt = bytearray(64)
+        self.dl_resp = bytearray(4 + MAX_BLK_LEN)
+        self.dl_resp[0:4] = b'biny'
+
+        # when "Receiving..." was last drawn
+        self.last_progress = 0
+
         self.encrypted_req = False
 
+        # per-command latency counters, for profiling host tools (see USBS command)
+        self.stats = {} if (is_simulator() or is_devmode) else None
+
         # not bound to a specific crypto setup by default
         self.bound = False
 
@@ -144,14 +158,16 @@ class USBHandler:
     def get_packet(self):
         # read next packet (64 bytes) waiting on the wire. Unframe it and return
         # active part of packet, flags associated.
-        buf = self.dev.recv(64, timeout=5000)
+        # - returned data is a view into our packet buffer, must be used before next call
+        buf = self.rx_pkt
+        count = self.dev.recv(buf, timeout=5000)
         ckcc.usb_active()
 
-        if not buf:
+        if not count:
             raise FramingError('timeout')
-        elif len(buf) < 64:
+        elif count < 64:
             raise FramingError('short')
-        elif len(buf) > 64:
+        elif count > 64:
             raise FramingError('long')
 
         # first byte gives us the actual size, status
@@ -161,7 +177,7 @@ class USBHandler:
         len_here = int(flag & 0x3f)
         is_encrypted = bool(flag & 0x40)
 
-        return buf[1:1+len_here], is_last, is_encrypted
+        return memoryview(buf)[1:1+len_here], is_last, is_encrypted
 
     async def usb_hid_recv(self):
         # blocks and builds up a full-length command packet in memory
@@ -281,7 +297,7 @@ class USBHandler:
 
         # handle simple types here
 
-        if isinstance(resp, (bytes, bytearray)):
+        if isinstance(resp, (bytes, bytearray, memoryview)):
             # preformated
             assert len(resp) >= 4
         elif resp is None:
@@ -294,7 +310,7 @@ class USBHandler:
 
         assert len(resp) >= 4
 
-        msg = bytearray(64)
+        msg = self.tx_pkt
 
         if self.encrypt and self.encrypted_req:
             resp = self.encrypt_response(resp)
@@ -302,6 +318,7 @@ class USBHandler:
         else:
             final_flag = 0x80
 
+        resp = memoryview(resp)
         pos = 0
         left = len(resp)
         while left:
@@ -325,8 +342,9 @@ class USBHandler:
                 # Host may not have read previous value yet, so might need
                 # to wait for it. Data loss possible here, but also the
                 # host may stop reading the EP forever, so not our fault.
-                # Let other stuff run during this delay.
-                await sleep_ms(10)
+                # Let other stuff run during this delay: short at first,
+                # since host usually polls again within a few ms.
+                await sleep_ms(1 if retries < 10 else 10)
 
     async def framing_error(self, why):
         # send error about framing, and recover
@@ -350,301 +368,417 @@ class USBHandler:
             except: 
                 pass
 
+        entry = USB_COMMANDS.get(cmd)
+        flags = entry[3] if entry else 0
+
         if hsm_active:
             # only a few commands are allowed during HSM mode
-            if cmd not in HSM_WHITELIST:
+            if not (flags & CMD_HSM):
                 raise HSMDenied
 
         if not settings.get('hsmcmd', False):
-            if cmd in HSM_DISABLE_CMDS:
+            if flags & CMD_HSMCMD:
                 raise HSMCMDDisabled
 
-        if cmd == 'dfu_':
-            # only useful in factory, undocumented.
-            return self.call_after(callgate.enter_dfu)
-
-        if cmd == 'rebo':
-            from auth import UserAuthorizedAction, FirmwareUpgradeRequest
-            import machine
-
-            req = UserAuthorizedAction.active_request
-            if req and isinstance(req, FirmwareUpgradeRequest):
-                # We're waiting on firmware upgrade approval, so don't reboot
-                # (which would not apply the upgrade anyway) and also don't
-                # give an error, because ckcc-protocol and other clients
-                # send the reboot as part of the old upgrade process.
-                return
-            return self.call_after(machine.reset)
-
-        if cmd == 'logo':
-            from utils import clean_shutdown
-            return self.call_after(clean_shutdown)
-
-        if cmd == 'ping':
-            return b'biny' + args
-
-        if cmd == 'upld':
-            offset, total_size = unpack_from('<II', args)
-            data = memoryview(args)[4+4:]
-
-            return await self.handle_upload(offset, total_size, data)
+        if not entry or ((flags & CMD_MK4) and not supports_hsm):
+            #print("USB garbage: %s +[%d]" % (cmd, len(args)))
 
-        if cmd == 'dwld':
-            offset, length, fileno = unpack_from('<III', args)
-            return await self.handle_download(offset, length, fileno)
+            # Force logout if bound and unknown command received
+            if self.bound:
+                from utils import clean_shutdown, call_later_ms
+                call_later_ms(250, clean_shutdown)
 
-        if cmd == 'ncry':
-            version, his_pubkey = unpack_from('<I64s', args)
+            return b'err_Unknown cmd'
 
-            return self.handle_crypto_setup(version, his_pubkey)
+        fn, fmt, size, _ = entry
 
-        if cmd == 'vers':
-            from version import get_mpy_version, hw_label
-            from callgate import get_bl_version
-
-            # Returning: date, version(human), bootloader version, full date version
-            # BUT: be ready for additions!
-            rv = list(get_mpy_version())
-            rv.insert(2, get_bl_version()[0])
-            rv.append(hw_label)
-
-            return b'asci' + ('\n'.join(rv)).encode()
-
-        if cmd == 'sha2':
-            return b'biny' + self.file_checksum.digest()
-
-        if cmd == 'xpub':
+        if flags & CMD_ENCRYPT:
             assert self.encrypted_req, 'must encrypt'
-            return self.handle_xpub(args)
-
-        if cmd == 'mitm':
-            assert self.encrypted_req, 'must encrypt'
-            return await self.handle_mitm_check()
-
-        if cmd == 'smsg':
-            # sign message
-            addr_fmt, len_subpath, len_msg = unpack_from('<III', args)
-            subpath = args[12:12+len_subpath]
-            msg = args[12+len_subpath:]
-            assert len(msg) == len_msg, "badlen"
-
-            from auth import sign_msg
-            sign_msg(msg, subpath, addr_fmt)
-            return None
 
-        if cmd == 'p2sh':
-            # show P2SH (probably multisig) address on screen (also provides it back)
-            # - must provide redeem script, and list of [xfp+path]
-            from auth import start_show_p2sh_address
+        # decode fixed part of arguments, and pass along the rest if wanted
+        if size:
+            if len(args) < size:
+                raise ValueError('badlen')
+            vals = unpack_from(fmt, args)
+        else:
+            vals = ()
 
-            if hsm_active and not hsm_active.approve_address_share(is_p2sh=True):
-                raise HSMDenied
+        if flags & CMD_TAIL:
+            vals += (args[size:], )
 
-            # new multsig goodness, needs mapping from xfp->path and M values
-            addr_fmt, M, N, script_len = unpack_from('<IBBH', args)
+        if self.stats is None:
+            return await fn(self, *vals)
 
-            assert addr_fmt & AFC_SCRIPT
-            assert 1 <= M <= N <= 20
-            assert 30 <= script_len <= 520
+        started = utime.ticks_us()
+        try:
+            return await fn(self, *vals)
+        finally:
+            self.record_time(cmd, utime.ticks_diff(utime.ticks_us(), started))
+
+    def record_time(self, cmd, usec):
+        # per-command latency: [count, total usec, worst usec]
+        st = self.stats.get(cmd)
+        if not st:
+            st = self.stats[cmd] = [0, 0, 0]
+
+        st[0] += 1
+        st[1] += usec
+        st[2] = max(st[2], usec)
+
+    def finished_request(self, req_cls=None):
+        # Have we finished (whatever) the transaction, which needed user approval?
+        # - returns the request once it has a result, else the response to send
+        from auth import UserAuthorizedAction
+
+        req = UserAuthorizedAction.active_request
+        if not req or (req_cls and not isinstance(req, req_cls)):
+            return None, b'err_No active request'
+
+        if req.refused:
+            UserAuthorizedAction.cleanup()
+            return None, b'refu'
+
+        if req.failed:
+            rv = b'err_' + req.failed.encode()
+            UserAuthorizedAction.cleanup()
+            return None, rv
+
+        if not req.result:
+            # STILL waiting on user
+            return None, None
+
+        return req, None
+
+    @usb_cmd('dfu_')
+    async def cmd_dfu(self):
+        # only useful in factory, undocumented.
+        return self.call_after(callgate.enter_dfu)
+
+    @usb_cmd('rebo')
+    async def cmd_reboot(self):
+        from auth import UserAuthorizedAction, FirmwareUpgradeRequest
+        import machine
+
+        req = UserAuthorizedAction.active_request
+        if req and isinstance(req, FirmwareUpgradeRequest):
+            # We're waiting on firmware upgrade approval, so don't reboot
+            # (which would not apply the upgrade anyway) and also don't
+            # give an error, because ckcc-protocol and other clients
+            # send the reboot as part of the old upgrade process.
+            return
+        return self.call_after(machine.reset)
+
+    @usb_cmd('logo', flags=CMD_HSM)
+    async def cmd_logout(self):
+        from utils import clean_shutdown
+        return self.call_after(clean_shutdown)
+
+    @usb_cmd('ping', flags=CMD_HSM|CMD_TAIL)
+    async def cmd_ping(self, args):
+        return b'biny' + args
+
+    @usb_cmd('upld', '<II', CMD_HSM|CMD_TAIL)
+    async def cmd_upload(self, offset, total_size, data):
+        return await self.handle_upload(offset, total_size, data)
+
+    @usb_cmd('dwld', '<III', CMD_HSM)
+    async def cmd_download(self, offset, length, fileno):
+        return await self.handle_download(offset, length, fileno)
+
+    @usb_cmd('ncry', '<I64s', CMD_HSM)
+    async def cmd_crypto_setup(self, version, his_pubkey):
+        return self.handle_crypto_setup(version, his_pubkey)
+
+    @usb_cmd('vers', flags=CMD_HSM)
+    async def cmd_version(self):
+        from version import get_mpy_version, hw_label
+        from callgate import get_bl_version
+
+        # Returning: date, version(human), bootloader version, full date version
+        # BUT: be ready for additions!
+        rv = list(get_mpy_version())
+        rv.insert(2, get_bl_version()[0])
+        rv.append(hw_label)
+
+        return b'asci' + ('\n'.join(rv)).encode()
+
+    @usb_cmd('sha2', flags=CMD_HSM)
+    async def cmd_checksum(self):
+        return b'biny' + self.file_checksum.digest()
+
+    @usb_cmd('xpub', flags=CMD_HSM|CMD_ENCRYPT|CMD_TAIL)
+    async def cmd_xpub(self, args):
+        return self.handle_xpub(args)
+
+    @usb_cmd('mitm', flags=CMD_HSM|CMD_ENCRYPT)
+    async def cmd_mitm(self):
+        return await self.handle_mitm_check()
+
+    @usb_cmd('smsg', '<III', CMD_HSM|CMD_TAIL)
+    async def cmd_sign_msg(self, addr_fmt, len_subpath, len_msg, args):
+        # sign message
+        subpath = args[0:len_subpath]
+        msg = args[len_subpath:]
+        assert len(msg) == len_msg, "badlen"
+
+        from auth import sign_msg
+        sign_msg(msg, subpath, addr_fmt)
+        return None
+
+    @usb_cmd('p2sh', '<IBBH', CMD_HSM|CMD_TAIL)
+    async def cmd_show_p2sh(self, addr_fmt, M, N, script_len, args):
+        # show P2SH (probably multisig) address on screen (also provides it back)
+        # - must provide redeem script, and list of [xfp+path]
+        from auth import start_show_p2sh_address
+        from glob import hsm_active
 
-            offset = 8
-            witdeem_script = args[offset:offset+script_len]
-            offset += script_len
+        if hsm_active and not hsm_active.approve_address_share(is_p2sh=True):
+            raise HSMDenied
 
-            assert len(witdeem_script) == script_len
+        # new multsig goodness, needs mapping from xfp->path and M values
+        assert addr_fmt & AFC_SCRIPT
+        assert 1 <= M <= N <= 20
+        assert 30 <= script_len <= 520
+
+        witdeem_script = args[0:script_len]
+        offset = script_len
+
+        assert len(witdeem_script) == script_len
+
+        xfp_paths = []
+        for i in range(N):
+            ln = args[offset]
+            assert 1 <= ln <= 16, 'badlen'
+            xfp_paths.append(unpack_from('<%dI' % ln, args, offset+1))
+            offset += (ln*4) + 1
+
+        assert offset == len(args)
+
+        return b'asci' + start_show_p2sh_address(M, N, addr_fmt, xfp_paths,
+                                                    witdeem_script)
+
+    @usb_cmd('show', '<I', CMD_HSM|CMD_TAIL)
+    async def cmd_show_address(self, addr_fmt, subpath):
+        # simple cases, older code: text subpath
+        from auth import usb_show_address
+
+        # regression patch of AFC_BECH32M flag
+        # fixed here https://github.com/Coldcard/ckcc-protocol/commit/a6d901f9fca50755835eca895586ca74d0ca81ed
+        if addr_fmt == 0x17:  # old P2TR
+            addr_fmt = 0x23   # new P2TR
+        return b'asci' + usb_show_address(addr_fmt, subpath=subpath)
+
+    @usb_cmd('enrl', '<I32s')
+    async def cmd_enroll(self, file_len, file_sha):
+        # Enroll new xpubkey to be involved in multisigs.
+        # - text config file must already be uploaded
+        if file_sha != self.file_checksum.digest():
+            return b'err_Checksum'
+        assert 100 < file_len <= (20*200), "badlen"
+
+        # Start an UX interaction, return immediately here
+        from auth import maybe_enroll_xpub
+        maybe_enroll_xpub(sf_len=file_len, ux_reset=True)
+
+        return None
+
+    @usb_cmd('msck', '<3I', CMD_HSM)
+    async def cmd_multisig_check(self, M, N, xfp_xor):
+        # Quick check to test if we have a wallet already installed.
+        from multisig import MultisigWallet
+
+        return int(MultisigWallet.quick_check(M, N, xfp_xor))
+
+    @usb_cmd('stxn', '<II32s', CMD_HSM)
+    async def cmd_sign_txn(self, txn_len, flags, txn_sha):
+        # sign transaction
+        if txn_sha != self.file_checksum.digest():
+            return b'err_Checksum'
+
+        assert 50 < txn_len <= MAX_TXN_LEN, "badlen"
+
+        from auth import sign_transaction
+        sign_transaction(txn_len, (flags & STXN_FLAGS_MASK), txn_sha)
+        return None
+
+    @usb_cmd('bupl', '<III', CMD_HSM|CMD_TAIL)
+    async def cmd_batch_upload(self, slot, offset, total_size, data):
+        # batch upload: one PSBT into a slot
+        return await self.handle_batch_upload(slot, offset, total_size, data)
+
+    @usb_cmd('bsig', '<II', CMD_HSM|CMD_TAIL)
+    async def cmd_batch_sign(self, count, flags, args):
+        # sign a batch of PSBT's, previously uploaded into slots 0..N-1
+        # - policy is applied per PSBT in HSM mode
+        from auth import sign_batch, BATCH_SLOT_SIZE, BATCH_MAX_SLOTS
+
+        assert 1 <= count <= BATCH_MAX_SLOTS, "count"
+        assert len(args) == (count * 36), "badlen"
+
+        items = []
+        for i in range(count):
+            txn_len, txn_sha = unpack_from('<I32s', args, i * 36)
+            assert 50 < txn_len <= BATCH_SLOT_SIZE, "badlen"
+            items.append((txn_len, txn_sha))
+
+        sign_batch(items, (flags & STXN_FLAGS_MASK))
+        return None
+
+    @usb_cmd('bsok', flags=CMD_HSM)
+    async def cmd_batch_result(self):
+        # batch done? provide status, length and checksum of each result
+        from auth import UserAuthorizedAction, ApproveBatch
+
+        req, rv = self.finished_request(ApproveBatch)
+        if not req:
+            return rv
+
+        rv = pack('<4sI', 'biny', len(req.result))
+        rv += b''.join(pack('<BI32s', *r) for r in req.result)
+        UserAuthorizedAction.cleanup()
+        return rv
+
+    @usb_cmd('bdwl', '<III', CMD_HSM)
+    async def cmd_batch_download(self, slot, offset, length):
+        # download a signed result from a batch slot
+        return await self.handle_batch_download(slot, offset, length)
+
+    @usb_cmd('stok', flags=CMD_HSM)
+    @usb_cmd('bkok')
+    async def cmd_file_result(self):
+        # generic file response: signed txn, or backup file
+        from auth import UserAuthorizedAction
+
+        req, rv = self.finished_request()
+        if not req:
+            return rv
+
+        resp_len, sha = req.result
+        UserAuthorizedAction.cleanup()
+        return pack('<4sI32s', 'strx', resp_len, sha)
+
+    @usb_cmd('smok', flags=CMD_HSM)
+    async def cmd_msg_result(self):
+        # signed message done: just give them the signature
+        from auth import UserAuthorizedAction
+
+        req, rv = self.finished_request()
+        if not req:
+            return rv
+
+        addr, sig = req.address, req.result
+        UserAuthorizedAction.cleanup()
+        return pack('<4sI', 'smrx', len(addr)) + addr.encode() + sig
+
+    @usb_cmd('pwok')
+    async def cmd_passphrase_result(self):
+        # return new root xpub
+        from auth import UserAuthorizedAction
+
+        req, rv = self.finished_request()
+        if not req:
+            return rv
+
+        xpub = req.result
+        UserAuthorizedAction.cleanup()
+        return b'asci' + bytes(xpub, 'ascii')
+
+    @usb_cmd('pass', flags=CMD_ENCRYPT|CMD_TAIL)
+    async def cmd_passphrase(self, args):
+        # bip39 passphrase provided, maybe use it if authorized
+        from auth import start_bip39_passphrase
+        from glob import settings
 
-            xfp_paths = []
-            for i in range(N):
-                ln = args[offset]
-                assert 1 <= ln <= 16, 'badlen'
-                xfp_paths.append(unpack_from('<%dI' % ln, args, offset+1))
-                offset += (ln*4) + 1
+        assert settings.get("words", True), 'no seed'
+        assert len(args) < 400, 'too long'
+        pw = str(args, 'utf8')
+        assert len(pw) < 100, 'too long'
 
-            assert offset == len(args)
+        return start_bip39_passphrase(pw)
 
-            return b'asci' + start_show_p2sh_address(M, N, addr_fmt, xfp_paths,
-                                                        witdeem_script)
+    @usb_cmd('back')
+    async def cmd_backup(self):
+        # start backup: asks user, takes long time.
+        from auth import start_remote_backup
+        return start_remote_backup()
 
-        if cmd == 'show':
-            # simple cases, older code: text subpath
-            from auth import usb_show_address
+    @usb_cmd('blkc', flags=CMD_HSM)
+    async def cmd_blockchain(self):
+        # report which blockchain we are configured for
+        from chains import current_chain
+        chain = current_chain()
+        return b'asci' + chain.ctype
 
-            addr_fmt, = unpack_from('<I', args)
-            # regression patch of AFC_BECH32M flag
-            # fixed here https://github.com/Coldcard/ckcc-protocol/commit/a6d901f9fca50755835eca895586ca74d0ca81ed
-            if addr_fmt == 0x17:  # old P2TR
-                addr_fmt = 0x23   # new P2TR
-            return b'asci' + usb_show_address(addr_fmt, subpath=args[4:])
+    @usb_cmd('bagi', flags=CMD_TAIL)
+    async def cmd_bag_number(self, args):
+        return self.handle_bag_number(args)
 
-        if cmd == 'enrl':
-            # Enroll new xpubkey to be involved in multisigs.
-            # - text config file must already be uploaded
+    # HSM and user-related features only supported on Mk4
 
+    @usb_cmd('hsms', flags=CMD_HSMCMD|CMD_MK4|CMD_TAIL)
+    async def cmd_hsm_start(self, args):
+        # HSM mode "start" -- requires user approval
+        if args:
             file_len, file_sha = unpack_from('<I32s', args)
             if file_sha != self.file_checksum.digest():
                 return b'err_Checksum'
-            assert 100 < file_len <= (20*200), "badlen"
-
-            # Start an UX interaction, return immediately here
-            from auth import maybe_enroll_xpub
-            maybe_enroll_xpub(sf_len=file_len, ux_reset=True)
+            assert 2 <= file_len <= (200*1000), "badlen"
+        else:
+            file_len = 0
 
-            return None
+        # Start an UX interaction but return (mostly) immediately here
+        from hsm_ux import start_hsm_approval
+        await start_hsm_approval(sf_len=file_len, usb_mode=True)
 
-        if cmd == 'msck':
-            # Quick check to test if we have a wallet already installed.
-            from multisig import MultisigWallet
-            M, N, xfp_xor = unpack_from('<3I', args)
+        return None
 
-            return int(MultisigWallet.quick_check(M, N, xfp_xor))
+    @usb_cmd('hsts', flags=CMD_HSM|CMD_HSMCMD|CMD_MK4)
+    async def cmd_hsm_status(self):
+        # can always query HSM mode
+        from hsm import hsm_status_report
+        import ujson
+        return b'asci' + ujson.dumps(hsm_status_report())
 
-        if cmd == 'stxn':
-            # sign transaction
-            txn_len, flags, txn_sha = unpack_from('<II32s', args)
-            if txn_sha != self.file_checksum.digest():
-                return b'err_Checksum'
+    @usb_cmd('gslr', flags=CMD_HSM|CMD_HSMCMD|CMD_MK4)
+    async def cmd_storage_locker(self):
+        # get the value held in the Storage Locker
+        from glob import hsm_active
+        assert hsm_active, 'need hsm'
+        return b'biny' + hsm_active.fetch_storage_locker()
 
-            assert 50 < txn_len <= MAX_TXN_LEN, "badlen"
+    # User Mgmt
 
-            from auth import sign_transaction
-            sign_transaction(txn_len, (flags & STXN_FLAGS_MASK), txn_sha)
-            return None
+    @usb_cmd('nwur', '<BBB', CMD_HSMCMD|CMD_MK4|CMD_TAIL)
+    async def cmd_new_user(self, auth_mode, ul, sl, args):
+        from users import Users
+        username = bytes(args[0:ul]).decode('ascii')
+        secret = bytes(args[ul:ul+sl])
 
-        if cmd == 'stok' or cmd == 'bkok' or cmd == 'smok' or cmd == 'pwok':
-            # Have we finished (whatever) the transaction,
-            # which needed user approval? If so, provide result.
-            from auth import UserAuthorizedAction
-
-            req = UserAuthorizedAction.active_request
-            if not req:
-                return b'err_No active request'
-
-            if req.refused:
-                UserAuthorizedAction.cleanup()
-                return b'refu'
-
-            if req.failed:
-                rv = b'err_' + req.failed.encode()
-                UserAuthorizedAction.cleanup()
-                return rv
-
-            if not req.result:
-                # STILL waiting on user
-                return None
-
-
-            if cmd == 'pwok':
-                # return new root xpub
-                xpub = req.result
-                UserAuthorizedAction.cleanup()
-                return b'asci' + bytes(xpub, 'ascii')
-            elif cmd == 'smok':
-                # signed message done: just give them the signature
-                addr, sig = req.address, req.result
-                UserAuthorizedAction.cleanup()
-                return pack('<4sI', 'smrx', len(addr)) + addr.encode() + sig
-            else:
-                # generic file response
-                resp_len, sha = req.result
-                UserAuthorizedAction.cleanup()
-                return pack('<4sI32s', 'strx', resp_len, sha)
+        return b'asci' + Users.create(username, auth_mode, secret).encode('ascii')
 
-        if cmd == 'pass':
-            # bip39 passphrase provided, maybe use it if authorized
-            assert self.encrypted_req, 'must encrypt'
-            from auth import start_bip39_passphrase
-            from glob import settings
-
-            assert settings.get("words", True), 'no seed'
-            assert len(args) < 400, 'too long'
-            pw = str(args, 'utf8')
-            assert len(pw) < 100, 'too long'
-
-            return start_bip39_passphrase(pw)
-
-        if cmd == 'back':
-            # start backup: asks user, takes long time.
-            from auth import start_remote_backup
-            return start_remote_backup()
-
-        if cmd == 'blkc':
-            # report which blockchain we are configured for
-            from chains import current_chain
-            chain = current_chain()
-            return b'asci' + chain.ctype
-
-        if cmd == 'bagi':
-            return self.handle_bag_number(args)
-
-        if supports_hsm:
-            # HSM and user-related features only supported on Mk4
-
-            if cmd == 'hsms':
-                # HSM mode "start" -- requires user approval
-                if args:
-                    file_len, file_sha = unpack_from('<I32s', args)
-                    if file_sha != self.file_checksum.digest():
-                        return b'err_Checksum'
-                    assert 2 <= file_len <= (200*1000), "badlen"
-                else:
-                    file_len = 0
-
-                # Start an UX interaction but return (mostly) immediately here
-                from hsm_ux import start_hsm_approval
-                await start_hsm_approval(sf_len=file_len, usb_mode=True)
-
-                return None
-
-            if cmd == 'hsts':
-                # can always query HSM mode
-                from hsm import hsm_status_report
-                import ujson
-                return b'asci' + ujson.dumps(hsm_status_report())
-
-            if cmd == 'gslr':
-                # get the value held in the Storage Locker
-                assert hsm_active, 'need hsm'
-                return b'biny' + hsm_active.fetch_storage_locker()
-
-            # User Mgmt
-            if cmd == 'nwur':     # new user
-                from users import Users
-                auth_mode, ul, sl = unpack_from('<BBB', args)
-                username = bytes(args[3:3+ul]).decode('ascii')
-                secret = bytes(args[3+ul:3+ul+sl])
-
-                return b'asci' + Users.create(username, auth_mode, secret).encode('ascii')
-
-            if cmd == 'rmur':     # delete user
-                from users import Users
-                ul, = unpack_from('<B', args)
-                username = bytes(args[1:1+ul]).decode('ascii')
-
-                return Users.delete(username)
-
-            if cmd == 'user':       # auth user (HSM mode)
-                from users import Users
-                totp_time, ul, tl = unpack_from('<IBB', args)
-                username = bytes(args[6:6+ul]).decode('ascii')
-                token = bytes(args[6+ul:6+ul+tl])
-
-                if hsm_active:
-                    # just queues these details, can't be checked until PSBT on-hand
-                    hsm_active.usb_auth_user(username, token, totp_time)
-                    return None
-                else:
-                    # dryrun/testing purposes: validate only, doesn't unlock nothing
-                    return b'asci' + Users.auth_okay(username, token, totp_time).encode('ascii')
+    @usb_cmd('rmur', '<B', CMD_HSMCMD|CMD_MK4|CMD_TAIL)
+    async def cmd_delete_user(self, ul, args):
+        from users import Users
+        username = bytes(args[0:ul]).decode('ascii')
 
-        #print("USB garbage: %s +[%d]" % (cmd, len(args)))
+        return Users.delete(username)
 
-        # Force logout if bound and unknown command received
-        if self.bound:
-            from utils import clean_shutdown, call_later_ms
-            call_later_ms(250, clean_shutdown)
+    @usb_cmd('user', '<IBB', CMD_HSM|CMD_HSMCMD|CMD_MK4|CMD_TAIL)
+    async def cmd_auth_user(self, totp_time, ul, tl, args):
+        # auth user (HSM mode), other user cmds not allowed then
+        from users import Users
+        from glob import hsm_active
 
-        return b'err_Unknown cmd'
+        username = bytes(args[0:ul]).decode('ascii')
+        token = bytes(args[ul:ul+tl])
 
+        if hsm_active:
+            # just queues these details, can't be checked until PSBT on-hand
+            hsm_active.usb_auth_user(username, token, totp_time)
+            return None
+        else:
+            # dryrun/testing purposes: validate only, doesn't unlock nothing
+            return b'asci' + Users.auth_okay(username, token, totp_time).encode('ascii')
 
     def call_after(self, func, *args):
         # we want to provide nice response before dying
@@ -720,21 +854,68 @@ class USBHandler:
         if offset == 0:
             self.file_checksum = sha256()
 
-        resp = bytearray(4 + length)
-        resp[0:4] = b'biny'
-        buf = memoryview(resp)[4:]
-
         pos = (MAX_TXN_LEN * file_number) + offset
 
+        return self.download_resp(pos, length)
+
+    def download_resp(self, pos, length):
+        # read PSRAM into preallocated response, and add to checksum
         from glob import PSRAM
+
+        resp = memoryview(self.dl_resp)[0:4+length]
+        buf = resp[4:]
         PSRAM.read(pos, buf)
 
         self.file_checksum.update(buf)
 
         return resp
 
-    async def handle_upload(self, offset, total_size, data):
+    async def handle_batch_upload(self, slot, offset, total_size, data):
+        # like handle_upload, but for PSBT's only, into a batch slot, and quietly
+        from auth import batch_slot_offset, BATCH_SLOT_SIZE, UserAuthorizedAction, ApproveBatch
+
+        if isinstance(UserAuthorizedAction.active_request, ApproveBatch):
+            # don't change PSBT's while they are being looked at
+            raise CCBusyError
+
+        if offset == 0:
+            self.file_checksum = sha256()
+            assert data[0:5] == b'psbt\xff', 'psbt'
+
+        assert offset % 256 == 0, 'alignment'
+        assert offset+len(data) <= total_size <= BATCH_SLOT_SIZE, 'long'
+
+        self.file_checksum.update(data)
+        self.psram_write(batch_slot_offset(slot) + offset, data)
+
+        return offset
+
+    def psram_write(self, pos, data):
+        # whole block in one go: aligned part direct into PSRAM, then any runt
         from glob import PSRAM
+
+        ln4 = len(data) & ~3
+        if ln4:
+            PSRAM.write_at(pos, ln4)[:] = data[0:ln4]
+        if ln4 != len(data):
+            PSRAM.write(pos + ln4, data[ln4:])
+
+    async def handle_batch_download(self, slot, offset, length):
+        # read back a signed PSBT from batch slot
+        from auth import batch_slot_offset, BATCH_SLOT_SIZE
+
+        length = min(length, MAX_BLK_LEN)
+
+        assert 0 <= offset < BATCH_SLOT_SIZE, "bad offset"
+        assert 1 <= length, 'len'
+        length = min(length, BATCH_SLOT_SIZE - offset)
+
+        if offset == 0:
+            self.file_checksum = sha256()
+
+        return self.download_resp(batch_slot_offset(slot, True) + offset, length)
+
+    async def handle_upload(self, offset, total_size, data):
         from glob import dis, hsm_active
         from utils import check_firmware_hdr
         from sigheader import FW_HEADER_OFFSET, FW_HEADER_SIZE, FW_HEADER_MAGIC
@@ -754,46 +935,56 @@ class USBHandler:
             if offset == 0:
                 assert data[0:5] == b'psbt\xff', 'psbt'
 
-        for pos in range(offset, offset+len(data), 256):
-            if pos % 4096 == 0:
+        end = offset + len(data)
+
+        if data:
+            # redraw progress by time, not bytes: it's slow compared to USB
+            now = utime.ticks_ms()
+            if offset == 0 or utime.ticks_diff(now, self.last_progress) >= PROGRESS_REDRAW_MS:
                 dis.fullscreen("Receiving...", offset/total_size)
+                self.last_progress = now
 
-            # write up to 256 bytes
-            here = data[pos-offset:pos-offset+256]
-            self.file_checksum.update(here)
+        self.file_checksum.update(data)
 
-            # Very special case for firmware upgrades: intercept and modify
-            # header contents on the fly, and also fail faster if wouldn't work
-            # on this specific hardware.
-            # - workaround: ckcc-protocol upgrade process understates the file
-            #   length and appends hdr, but that's kinda a bug, so support both
-            is_trailer = (pos == (total_size - FW_HEADER_SIZE) or pos == total_size)
+        # Very special case for firmware upgrades: intercept and modify
+        # header contents on the fly, and also fail faster if wouldn't work
+        # on this specific hardware.
+        # - workaround: ckcc-protocol upgrade process understates the file
+        #   length and appends hdr, but that's kinda a bug, so support both
+        pos = FW_HEADER_OFFSET & ~255
+        if offset <= pos < end:
+            here = data[pos-offset:pos-offset+256]
+            hdr = memoryview(here)[-128:]
+            magic, = unpack_from('<I', hdr[0:4])
+            if magic == FW_HEADER_MAGIC:
+                prob = check_firmware_hdr(hdr, total_size)
+                if prob:
+                    raise ValueError(prob)
+                self.is_fw_upgrade = bytes(hdr)
+                assert not pa.tmp_value, "tmp"
+
+        if self.is_fw_upgrade:
+            for pos in (total_size - FW_HEADER_SIZE, total_size):
+                if pos % 256 or not (offset <= pos < end):
+                    continue
 
-            if pos == (FW_HEADER_OFFSET & ~255):
-                hdr = memoryview(here)[-128:]
-                magic, = unpack_from('<I', hdr[0:4])
-                if magic == FW_HEADER_MAGIC:
-                    prob = check_firmware_hdr(hdr, total_size)
-                    if prob:
-                        raise ValueError(prob)
-                    self.is_fw_upgrade = bytes(hdr)
-                    assert not pa.tmp_value, "tmp"
-
-            if is_trailer and self.is_fw_upgrade:
                 # expect the trailer to exactly match the original one
+                here = data[pos-offset:pos-offset+256]
                 assert len(here) == 128      # == FW_HEADER_SIZE
                 hdr = memoryview(here)[-128:]
                 assert hdr == self.is_fw_upgrade        # indicates hacking
 
                 # but don't write it, instead offer user a chance to abort
+                self.psram_write(offset, data[0:pos-offset])
+
                 from auth import authorize_upgrade
                 authorize_upgrade(self.is_fw_upgrade, pos, psram_offset=0)
 
                 # pretend we wrote it, so ckcc-protocol or whatever gives normal feedback
                 return offset
 
-            # write to PSRAM
-            PSRAM.write(pos, here)
+        # write to PSRAM
+        self.psram_write(offset, data)
 
         if offset+len(data) >= total_size and not hsm_active:
             # probably done
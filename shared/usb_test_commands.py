@@ -36,6 +36,22 @@ def do_usb_command(cmd, args):
             exec(str(args, 'utf8'), None, dict(RV=RV))
             return b'biny' + RV.getvalue()
 
+        if cmd == 'PERF':
+            # phase timings from most recent PSBT approval, as JSON
+            import ujson
+            from perf import PERF
+            return b'biny' + ujson.dumps(PERF.report()).encode()
+
+        if cmd == 'USBS':
+            # per-command USB latency counters, as JSON: {cmd: [count, total us, max us]}
+            # - non-empty args resets them
+            import ujson
+            from usb import handler
+            rv = ujson.dumps(handler.stats)
+            if args:
+                handler.stats.clear()
+            return b'biny' + rv.encode()
+
     except BaseException as exc:
         tmp = uio.StringIO()
         sys.print_exception(exc, tmp)
@@ -129,14 +129,14 @@ async def ux_wait_keydown(allowed=None, timeout_ms=None):
     # Wait for PRESS (not press+release) of any key. Return it and arrange so
     # that the later release doesn't cause confusion.
     # - no key repeat here
+    # - timeout is wall time, since other tasks may hold the CPU between our polls
     from glob import numpad
 
-    t = 0
+    t0 = utime.ticks_ms()
     while 1:
         if numpad.empty():
             await sleep_ms(1)
-            t += 1
-            if timeout_ms and t >= timeout_ms:
+            if timeout_ms and utime.ticks_diff(utime.ticks_ms(), t0) >= timeout_ms:
                 return None
             continue
 
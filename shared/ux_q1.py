@@ -1085,6 +1085,10 @@ async def ux_visualize_textqr(txt, maxlen=200):
     await ux_show_story("%s\n\nAbove is text that was scanned. "
             "We can't do any more with it." % txt, title="Simple Text")
 
+# Last set of BBQr frames rendered into PSRAM (at zero), so showing the same data
+# again is instant: (key, hash of frames, details needed to draw them)
+_bbqr_frames = None
+
 async def show_bbqr_codes(type_code, data, msg, already_hex=False):
     # Compress, encode and split data, then show it animated...
     # - happily goes to version 40 if needed
@@ -1092,41 +1096,78 @@ async def show_bbqr_codes(type_code, data, msg, already_hex=False):
     # - version of first QR is used for all ther others
     # - screen resolution is considered when picking QR version number
     # - data may point to output side of PSRAM area
-    # - Should always do zlib compression (because it nearly always helps)
-    #    - BUT: need zlib compress (not present) .. delayed for now
-    from bbqr import TYPE_LABELS, int2base36, b32encode, num_qr_needed
+    # - zlib compression used whenever it reduces the number of QR needed
+    # - animation starts once first frame is ready, rest are rendered in background
+    global _bbqr_frames
+    from glob import PSRAM
+    from uhashlib import sha256
+
+    assert not PSRAM.is_at(data, 0)     # input data would be overwritten with our work
+
+    if isinstance(data, str):
+        data = data.encode()
+
+    key = sha256((type_code + ('H' if already_hex else '2')).encode())
+    key.update(data)
+    key = key.digest()
+
+    frames = None
+    if _bbqr_frames and _bbqr_frames[0] == key:
+        # same data as last time; frames still good if PSRAM wasn't reused since
+        _, chk, frames = _bbqr_frames
+        num_parts, qr_size = frames[0], frames[1]
+        if ngu.hash.sha256s(PSRAM.read_at(0, qr_size * num_parts)) != chk:
+            frames = None
+
+    _bbqr_frames = None
+    task = None
+    try:
+        if frames:
+            ready = [frames[0]]
+        else:
+            ready = [0]
+            frames, task = render_bbqr_frames(type_code, data, already_hex, ready)
+
+        await animate_bbqr_frames(frames, msg, ready)
+    finally:
+        if task:
+            task.cancel()
+
+    if ready[0] == frames[0]:
+        # all rendered: remember them
+        num_parts, qr_size = frames[0], frames[1]
+        chk = ngu.hash.sha256s(PSRAM.read_at(0, qr_size * num_parts))
+        _bbqr_frames = (key, chk, frames)
+
+def render_bbqr_frames(type_code, data, already_hex, ready):
+    # Encode data as BBQr and render QR's into PSRAM, in slots starting at zero
+    # - first frame done now, since it picks the QR version for all the others
+    # - returns frame details, and task that renders the rest (or None)
+    # - ready[0] counts frames rendered so far
+    from bbqr import TYPE_LABELS, int2base36, b32encode, pick_encoding
     from glob import PSRAM, dis
-    from ux import ux_wait_keyup, ux_wait_keydown
     import uqr
 
-    assert not PSRAM.is_at(data, 0)     # input data would be overwritten with our work
     assert type_code in TYPE_LABELS
 
     dis.fullscreen('Generating BBQr...', .1)
 
-    if already_hex:
-        encoding = 'H'
-        data_len = len(data) // 2
-    else:
-        # default to Base32, because always best option
-        encoding = '2'
-        data_len = len(data)
-
-    # try a few select resolutions (sizes) in order such that we use either single QR
-    # or the least-dense option that gives reasonable number of QR's
-    target_vers, num_parts, part_size = num_qr_needed(encoding, data_len)
+    # pick encoding (maybe compressing) and then a few select resolutions (sizes) in
+    # order such that we use either single QR or the least-dense option that gives
+    # reasonable number of QR's
+    encoding, data, data_len, target_vers, num_parts, part_size = \
+                                        pick_encoding(data, already_hex)
 
     assert num_parts * part_size >= data_len
 
-    pos = 0
-    force_version = 40
-    for pkt in range(num_parts):
+    def render(pkt, version):
         # BBQr header
         hdr = 'B$' + encoding + type_code + int2base36(num_parts) + int2base36(pkt)
 
         # encode the bytes
+        pos = pkt * part_size
         assert pos < data_len, (pkt, pos, data_len)
-        if already_hex:
+        if encoding == 'H':
             # not encoding, just chars->bytes
             hp = pos*2
             body = data[hp:hp+(part_size*2)].decode()
@@ -1134,29 +1175,43 @@ async def show_bbqr_codes(type_code, data, msg, already_hex=False):
             # base32 encoding
             body = b32encode(data[pos:pos+part_size])
 
-        pos += part_size
-
         # do the hard work
-        qr_data = uqr.make(hdr+body, min_version=(10 if pkt == 0 else force_version),
-                                    max_version=force_version, encoding=uqr.Mode_ALPHANUMERIC)
-
-        # save the rendered QR
-        if pkt == 0:
-            # common values for all parts
-            scan_w, w, raw = qr_data.packed()
-            raw_qr_size = len(raw)
-            qr_size = (raw_qr_size + 3) & ~0x3        # align4
-            force_version = qr_data.version()
-            assert force_version <= target_vers
-        else:
-            _, _, raw = qr_data.packed()
+        return uqr.make(hdr+body, min_version=(10 if pkt == 0 else version),
+                                    max_version=version, encoding=uqr.Mode_ALPHANUMERIC)
 
-        PSRAM.write_at(qr_size * pkt, qr_size)[0:raw_qr_size] = raw
+    # common values for all parts
+    qr_data = render(0, 40)
+    scan_w, w, raw = qr_data.packed()
+    raw_qr_size = len(raw)
+    qr_size = (raw_qr_size + 3) & ~0x3        # align4
+    force_version = qr_data.version()
+    assert force_version <= target_vers
+    del qr_data
 
-        del qr_data
+    PSRAM.write_at(0, qr_size)[0:raw_qr_size] = raw
+    ready[0] = 1
+
+    async def render_rest():
+        # save the rendered QR's, yielding to animation between each
+        for pkt in range(1, num_parts):
+            _, _, raw = render(pkt, force_version).packed()
+            PSRAM.write_at(qr_size * pkt, qr_size)[0:raw_qr_size] = raw
+            ready[0] = pkt + 1
+
+            await sleep_ms(0)
+
+    task = asyncio.create_task(render_rest()) if num_parts > 1 else None
+
+    return (num_parts, qr_size, raw_qr_size, scan_w, w), task
+
+async def animate_bbqr_frames(frames, msg, ready):
+    # Show pre-rendered BBQr frames from PSRAM until a key is pressed
+    # - only cycles thru those frames rendered so far (ready[0])
+    from glob import PSRAM, dis
+    from ux import ux_wait_keydown
+
+    num_parts, qr_size, raw_qr_size, scan_w, w = frames
 
-        dis.progress_bar_show((pkt+1) / num_parts)
-    
     # display rate (plus time to send to display, etc)
     ms_per_each = 200
 
@@ -1165,23 +1220,25 @@ async def show_bbqr_codes(type_code, data, msg, already_hex=False):
     dis.show()
 
     ch = None
+    pkt = 0
     while not ch:
-        for pkt in range(num_parts):
-            buf = PSRAM.read_at(qr_size * pkt, raw_qr_size)
-            dis.draw_qr_display( (scan_w, w, buf), msg, True, None, None, False, 
-                                    partial_bar=((pkt, num_parts) if num_parts else None))
-
-            if num_parts == 1:
-                # no need for animation
-                ch = await ux_wait_keydown()
-                break
+        buf = PSRAM.read_at(qr_size * pkt, raw_qr_size)
+        dis.draw_qr_display( (scan_w, w, buf), msg, True, None, None, False, 
+                                partial_bar=((pkt, num_parts) if num_parts else None))
+
+        if num_parts == 1:
+            # no need for animation
+            ch = await ux_wait_keydown()
+            break
+
+        # wait for key or animation delay
+        ch = await ux_wait_keydown(None, ms_per_each)
 
-            # wait for key or animation delay
-            ch = await ux_wait_keydown(None, ms_per_each)
-            if ch: break
+        pkt += 1
+        if pkt >= ready[0]:
+            pkt = 0
 
     # after QR drawing, we need to correct some pixels
     dis.clear()
 
-
 # EOF
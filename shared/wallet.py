@@ -9,6 +9,14 @@ from stash import SensitiveValues
 
 MAX_BIP32_IDX = (2 ** 31) - 1
 
+# addresses made per batch, by address_batches()
+ADDR_BATCH_SIZE = const(20)
+
+# xpub-only nodes for recently used account/change paths: (master xpub, path) => node
+# - public keys only, so nothing secret held here
+PUB_NODES = {}
+PUB_NODES_MAX = const(8)
+
 class WalletABC:
     # How to make this ABC useful without consuming memory/code space??
     # - be more of an "interface" than a base class
@@ -83,42 +91,75 @@ class MasterSingleSigWallet(WalletABC):
         self._path = p
 
 
+    def public_node(self, path):
+        # xpub-only node for path, usually account+change level. Slow first time,
+        # since accesses SE, but then cached so address ranges need only public derivation.
+        from glob import settings
+
+        key = (settings.get('xpub'), path)
+        node = PUB_NODES.get(key)
+        if node is None:
+            with SensitiveValues() as sv:
+                xpub = self.chain.serialize_public(sv.derive_path(path))
+
+            node = self.chain.deserialize_node(xpub, AF_CLASSIC)
+
+            if key[0]:
+                if len(PUB_NODES) >= PUB_NODES_MAX:
+                    PUB_NODES.clear()
+                PUB_NODES[key] = node
+
+        return node
+
+    def address_batches(self, start_idx, count, change_idx=None):
+        # Make a range of addresses, a batch at a time: yields list of (idx, address)
+        # - same list is reused for next batch, so consume before asking for more
+        path = self._path
+        if change_idx is not None:
+            assert 0 <= change_idx <= 1
+            path += '/%d' % change_idx
+
+        parent = self.public_node(path)
+        batch = []
+
+        count = min(count, MAX_BIP32_IDX + 1 - start_idx)
+        while count > 0:
+            here = min(count, ADDR_BATCH_SIZE)
+
+            batch.clear()
+            for idx in range(start_idx, start_idx+here):
+                node = parent.copy()
+                node.derive(idx, False)            # works in-place
+                batch.append((idx, self.chain.address(node, self.addr_fmt)))
+
+            yield batch
+
+            start_idx += here
+            count -= here
+
     def yield_addresses(self, start_idx, count, change_idx=None):
-        # Render a range of addresses. Slow to start, since accesses SE in general
-        # - if count==1, don't derive any subkey, just do path.
+        # Render a range of addresses.
+        # - if count==None, don't derive any subkey, just do path.
         path = self._path
         if change_idx is not None:
             assert 0 <= change_idx <= 1
             path += '/%d' % change_idx
 
-        with SensitiveValues() as sv:
-            node = sv.derive_path(path)
-
-            if count is None:  # special case - showing single, ignoring start_idx
-                address = self.chain.address(node, self.addr_fmt)
-                yield 0, address, path
-                return
-
-            path += '/'
-            for idx in range(start_idx, start_idx+count):
-                if idx > MAX_BIP32_IDX:
-                    break
-                try:
-                    here = node.copy()
-                    here.derive(idx, False)            # works in-place
-                    address = self.chain.address(here, self.addr_fmt)
-                finally:
-                    here.blank()
-                    del here
+        if count is None:  # special case - showing single, ignoring start_idx
+            address = self.chain.address(self.public_node(path), self.addr_fmt)
+            yield 0, address, path
+            return
 
+        path += '/'
+        for batch in self.address_batches(start_idx, count, change_idx):
+            for idx, address in batch:
                 yield idx, address, path+str(idx)
 
     def render_address(self, change_idx, idx):
         # Optimized for a single address.
-        path = self._path + '/%d/%d' % (change_idx, idx)
-        with SensitiveValues() as sv:
-            node = sv.derive_path(path)
-            return self.chain.address(node, self.addr_fmt)
+        node = self.public_node(self._path + '/%d' % change_idx).copy()
+        node.derive(idx, False)
+        return self.chain.address(node, self.addr_fmt)
 
     def render_path(self, change_idx, idx):
         # show the derivation path for an address
@@ -0,0 +1,34 @@
+# (c) Copyright 2024 by Coinkite Inc. This file is covered by license found in COPYING-CC.
+#
+# SensitiveValues.derive_path w/ cache of parent nodes: must match uncached derivation
+#
+from stash import SensitiveValues
+
+paths = ["m/84h/0h/0h/0/%d" % i for i in range(5)] \
+        + ["m/84h/0h/0h/1/%d" % i for i in range(5)] \
+        + ["m/44'/1'/0'", "m/0", "m"]
+
+with SensitiveValues() as sv:
+    for p in paths:
+        a = sv.derive_path(p, register=False)
+        b = sv.derive_path(p, master=sv.node, register=False)
+
+        assert a.pubkey() == b.pubkey(), p
+        assert a.privkey() == b.privkey(), p
+        assert a.chain_code() == b.chain_code(), p
+
+        a.blank()
+        b.blank()
+
+    H = True
+    assert set(sv._prefix_cache.keys()) == {
+        ((84, H),), ((84, H), (0, H)), ((84, H), (0, H), (0, H)),
+        ((84, H), (0, H), (0, H), (0, False)), ((84, H), (0, H), (0, H), (1, False)),
+        ((44, H),), ((44, H), (1, H)),
+    }
+
+    cached = list(sv._prefix_cache.values())
+    assert all(n in sv.spots for n in cached)
+
+# wiped on exit
+assert not hasattr(sv, '_prefix_cache')
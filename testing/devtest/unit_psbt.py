@@ -38,6 +38,20 @@ with SFFile(0, max_size=MAX_TXN_LEN) as wr_fd:
 rd_fd = SFFile(0, tl)
 obj = psbtObject.read_psbt(rd_fd)
 
+if obj.txn:
+    # txn index vs. plain old deserialize
+    from serializations import CTransaction
+    from uio import BytesIO
+
+    txn = CTransaction()
+    txn.deserialize(BytesIO(obj.get(obj.txn)))
+
+    assert [(i.prevout.hash, i.prevout.n, i.nSequence) for _, i in obj.input_iter()] \
+                == [(i.prevout.hash, i.prevout.n, i.nSequence) for i in txn.vin]
+    assert [(o.nValue, o.scriptPubKey) for _, o in obj.output_iter()] \
+                == [(o.nValue, o.scriptPubKey) for o in txn.vout]
+    assert obj.total_value_out == sum(o.nValue for o in txn.vout)
+
 # Many of these trival PSBT test cases now fail validation for various reasons,
 # and that's correct thing to do.
 try:
@@ -511,4 +511,29 @@ def test_clone_start(reset_seed_words, pick_menu_item, cap_story, goto_home):
     # TODO check file made is a good backup, with correct password
 
 
+@pytest.mark.parametrize('chunk', [1, 15, 17, 1023, 1025])
+def test_stream_7z(chunk, sim_exec):
+    # encrypt with Builder.write() a few bytes at a time, and read back whole
+    # - odd length so final block is padded
+    cmd = f'''
+import compat7z, uio
+data = bytes(((i*7) + (i >> 8)) & 0xff for i in range(5003))
+zz = compat7z.Builder(password='test pw', rounds_pow=8)
+fd = uio.BytesIO()
+zz.stream_start(fd)
+for pos in range(0, len(data), {chunk}):
+    here = data[pos:pos+{chunk}]
+    assert zz.write(here) == len(here)
+hdr = zz.stream_finish('streamed.txt')
+fd.seek(0)
+fd.write(hdr)
+fd.seek(0)
+fname, got = compat7z.Builder().read_file(fd, 'test pw', 10000)
+RV.write(repr([fname, zz.unpacked_size, zz.padding, got == data]))'''
+
+    rv = sim_exec(cmd)
+    assert 'Traceback' not in rv, rv
+    assert eval(rv) == ['streamed.txt', 5003, 16 - (5003 % 16), True]
+
+
 # EOF
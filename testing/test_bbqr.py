@@ -163,6 +163,85 @@ def test_show_bbqr_sizes(size, cap_screen_qr, sim_exec, render_bbqr):
     assert data2.decode('utf-8') == data
     assert ft == 'U'
 
+@pytest.mark.parametrize('size', [ 2060*2, 5000, 65537] )
+def test_show_bbqr_compressed(size, render_bbqr, sim_exec):
+    # compressible data should be sent zlib compressed, in fewer parts
+    size = size // 4 * 4
+    data, parts = render_bbqr(str_expr=f"'abcd'*{size//4}", msg=f'Zlib {size}', file_type='U')
+    assert data == 'abcd' * (size//4)
+
+    resp = sim_exec(f'import bbqr; RV.write(repr(bbqr.num_qr_needed("2", {size})))')
+    _, plain_parts, _ = eval(resp)
+
+    assert all(p[2] == 'Z' for p in parts.values())
+    assert len(parts) < plain_parts
+
+# runs in simulator too, so must be valid MicroPython
+MIXED_DATA_SRC = '''
+def mixed_data(size, seed=7):
+    # deterministic: random literal runs, then repeats at distances
+    # around the 1024 window limit, or short ones, of lengths 3..257
+    rv = bytearray()
+    x = seed
+    step = 0
+    while len(rv) < size:
+        x = (x * 1103515245 + 12345) & 0x7fffffff
+        kind = (x >> 16) % 3
+        ln = 3 + (step % 255)
+        step += 1
+        if kind == 0 or len(rv) < 1040:
+            for i in range(1 + ((x >> 8) % 16)):
+                x = (x * 1103515245 + 12345) & 0x7fffffff
+                rv.append((x >> 16) & 0xff)
+            continue
+        if kind == 1:
+            dist = 1000 + ((x >> 4) % 41)
+        else:
+            dist = 1 + ((x >> 4) % 64)
+        for i in range(ln):
+            rv.append(rv[-dist])
+    return bytes(rv[0:size])
+'''
+
+@pytest.mark.parametrize('size', [ 20000, 40000 ] )
+def test_show_bbqr_mixed(size, render_bbqr, sim_exec):
+    # compressor round trip on less friendly data than repeated text
+    ns = {}
+    exec(MIXED_DATA_SRC, ns)
+    expect = ns['mixed_data'](size)
+
+    resp = sim_exec(MIXED_DATA_SRC + f'\nimport main; main.MIXED = mixed_data({size})')
+    assert 'error' not in resp.lower()
+
+    data, parts = render_bbqr(str_expr='main.MIXED', setup='import main',
+                                    msg=f'Mixed {size}', file_type='B')
+    assert data == expect
+    assert all(p[2] == 'Z' for p in parts.values())
+
+def test_show_bbqr_incompressible(render_bbqr, sim_exec):
+    # random data: compression cannot help, so must fall back to Base32
+    from hashlib import sha256
+
+    resp = sim_exec('import main, ngu; from ubinascii import hexlify as b2a_hex; '
+                    'main.RND = ngu.random.bytes(6000); '
+                    'RV.write(b2a_hex(ngu.hash.sha256s(main.RND)))')
+    assert 'error' not in resp.lower()
+
+    data, parts = render_bbqr(str_expr='main.RND', setup='import main',
+                                    msg='Random', file_type='B')
+    assert len(data) == 6000
+    assert sha256(data).hexdigest() == resp
+    assert all(p[2] == '2' for p in parts.values())
+
+def test_show_bbqr_again(render_bbqr):
+    # second showing of same data uses frames cached from the first
+    args = dict(str_expr="'abcd'*5000 + 'x'*20000", msg='Again', file_type='U')
+    data, parts = render_bbqr(**args)
+    data2, parts2 = render_bbqr(**args)
+
+    assert data2 == data
+    assert parts2 == parts
+
 @pytest.mark.parametrize('src', [ 'rng', 'gpu', 'bigger'] )
 def test_show_bbqr_contents(src, cap_screen_qr, sim_exec, render_bbqr, load_shared_mod):
 
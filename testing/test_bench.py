@@ -0,0 +1,121 @@
+# (c) Copyright 2024 by Coinkite Inc. This file is covered by license found in COPYING-CC.
+#
+# PSBT signing benchmarks: throughput vs. txn size and address type.
+#
+# - builds fake PSBT's, signs them over USB, and collects the PERF phase timings
+# - results land in debug/bench-<git rev>.json, so two commits can be compared
+# - not run by default; use:
+#       pytest test_bench.py -m bench -s
+#       pytest test_bench.py -m bench -k 'p2wpkh and 100-' -s       # subset
+#       python test_bench.py debug/bench-OLD.json debug/bench-NEW.json
+#
+import pytest, time, json, subprocess
+
+
+# address types benchmarked; multisig is always 2-of-3 with the simulator as co-signer
+BENCH_STYLES = ['p2pkh', 'p2wpkh', 'p2wpkh-p2sh', 'p2wsh-ms']
+
+
+def git_rev():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+                                            text=True).strip()
+    except Exception:
+        return 'unknown'
+
+@pytest.fixture(scope='module')
+def bench_report():
+    # collect results over whole module, write once at end
+    results = []
+    yield results
+
+    if not results:
+        return
+
+    rv = dict(rev=git_rev(), when=time.strftime('%Y-%m-%d %H:%M:%S'), results=results)
+    fn = 'debug/bench-%s.json' % rv['rev']
+    with open(fn, 'wt') as fd:
+        json.dump(rv, fd, indent=1, sort_keys=True)
+
+    print("\nBenchmark results: " + fn)
+
+def phase_summary(phases):
+    # PERF report -> {phase: ms}, plus worst-case memory drop over any one phase
+    timing = {}
+    mem_used = 0
+    for p in phases:
+        timing[p['phase']] = timing.get(p['phase'], 0) + p['ms']
+        if p['mem'] is not None:
+            mem_used = max(mem_used, -p['mem'])
+
+    return timing, mem_used
+
+
+@pytest.mark.bench
+@pytest.mark.veryslow
+@pytest.mark.unfinalized
+@pytest.mark.parametrize('psbt_v2', [False, True])
+@pytest.mark.parametrize('style', BENCH_STYLES)
+@pytest.mark.parametrize('num_outs', [2, 20])
+@pytest.mark.parametrize('num_ins', [1, 10, 100, 1000])
+def test_sign_bench(num_ins, num_outs, style, psbt_v2, dev, fake_txn, fake_ms_txn,
+                    clear_ms, import_ms_wallet, start_sign, end_sign, bench_report):
+    if style.endswith('-ms'):
+        if psbt_v2:
+            raise pytest.skip('fake_ms_txn does not make PSBTv2')
+
+        clear_ms()
+        keys = import_ms_wallet(2, 3, name='bench', accept=1, addr_fmt='p2wsh')
+        psbt = fake_ms_txn(num_ins, num_outs, 2, keys, segwit_in=True,
+                            outstyles=['p2wsh'], change_outputs=[0])
+    else:
+        psbt = fake_txn(num_ins, num_outs, dev.master_xpub,
+                            segwit_in=(style != 'p2pkh'), wrapped=(style == 'p2wpkh-p2sh'),
+                            outstyles=[style], change_outputs=[0], psbt_v2=psbt_v2)
+
+    dt = time.time()
+    start_sign(psbt, finalize=False)
+    upload_time = time.time() - dt
+
+    dt = time.time()
+    signed = end_sign(accept=True, finalize=False)
+    sign_time = time.time() - dt
+
+    assert signed != psbt
+
+    phases = json.loads(dev.send_recv(b'PERF'))
+    timing, mem_used = phase_summary(phases)
+
+    bench_report.append(dict(num_ins=num_ins, num_outs=num_outs, style=style,
+                                psbt_v2=psbt_v2, psbt_len=len(psbt),
+                                upload_sec=round(upload_time, 3),
+                                sign_sec=round(sign_time, 3),
+                                phases_ms=timing, max_mem_used=mem_used))
+
+    print("%4d ins %3d outs %-12s v%d: %7.2f sec" % (num_ins, num_outs, style,
+                                                        2 if psbt_v2 else 0, sign_time))
+
+
+def compare(old_fn, new_fn):
+    # print side-by-side of two bench runs, matched on test params
+    def load(fn):
+        with open(fn, 'rt') as fd:
+            d = json.load(fd)
+        return d['rev'], {(r['num_ins'], r['num_outs'], r['style'], r['psbt_v2']): r
+                                    for r in d['results']}
+
+    old_rev, old = load(old_fn)
+    new_rev, new = load(new_fn)
+
+    print('%-36s %10s %10s %7s' % ('case', old_rev, new_rev, 'ratio'))
+    for key in sorted(set(old) & set(new)):
+        a = old[key]['sign_sec']
+        b = new[key]['sign_sec']
+        label = '%d/%d %s%s' % (key[0], key[1], key[2], ' v2' if key[3] else '')
+        print('%-36s %10.2f %10.2f %7.2f' % (label, a, b, (b/a) if a else 0))
+
+if __name__ == '__main__':
+    import sys
+    compare(*sys.argv[1:3])
+
+# EOF
@@ -544,6 +544,42 @@ def test_simple_limit(dev, amount, over, start_hsm, fake_txn, attempt_psbt, twea
         tweak_rule(0, dict(max_amount=int(amount+over)))
         attempt_psbt(psbt)
 
+def test_batch_sign_hsm(dev, start_hsm, fake_txn, hsm_status, amount=1E6):
+    # batch in HSM mode: each PSBT is checked against policy on its own,
+    # and one refusal doesn't stop the others
+    from test_sign import batch_upload, batch_download
+
+    policy = DICT(rules=[dict(max_amount=int(amount))])
+    start_hsm(policy)
+
+    over = [False, True, False]
+    psbts = [fake_txn(2, 2, dev.master_xpub, change_outputs=[1], fee=0,
+                        outvals=[amount+(1000 if o else 0), 2E8-amount-(1000 if o else 0)])
+                for o in over]
+
+    dev.send_recv(b'bsig' + batch_upload(dev, psbts))
+
+    resp = None
+    while resp is None:
+        time.sleep(0.050)
+        resp = dev.send_recv(b'bsok', timeout=None)
+
+    count, = struct.unpack_from('<I', resp)
+    assert count == len(psbts)
+
+    for slot, (psbt, o) in enumerate(zip(psbts, over)):
+        status, ln, sha = struct.unpack_from('<BI32s', resp, 4 + (slot * 37))
+        if o:
+            assert status == 1          # REFUSED
+            assert ln == 0
+        else:
+            assert status == 0          # SIGNED
+            signed = batch_download(dev, slot, ln)
+            assert sha256(signed).digest() == sha
+            assert signed != psbt
+
+    assert 'amount exceeded' in hsm_status().last_refusal
+
 def test_named_wallets(dev, start_hsm, tweak_rule, make_myself_wallet, hsm_status,
                        attempt_psbt, fake_txn, fake_ms_txn, amount=5E6, incl_xpubs=False):
     wname = 'Myself-4'
@@ -949,6 +985,32 @@ def test_must_log(dev, start_hsm, sd_cards_eject, attempt_msg_sign, fake_txn, at
         attempt_msg_sign(None, b'hello', 'm', addr_fmt=AF_CLASSIC)
         attempt_psbt(psbt)
 
+def test_log_contents(start_hsm, attempt_msg_sign, microsd_path, is_simulator):
+    # must_log flushes before approval, so entries are on card once signed
+    import glob, os
+    if not is_simulator():
+        raise pytest.skip('need simulated card')
+
+    policy = DICT(must_log=True, msg_paths=['m'], rules=[{}])
+    start_hsm(policy)
+
+    msgs = [b'hello %d' % i for i in range(5)]
+    for m in msgs:
+        attempt_msg_sign(None, m, 'm', addr_fmt=AF_CLASSIC)
+
+    # all requests share one (latest) rotated file
+    fn = sorted(glob.glob(microsd_path('messages/audit-*.log')))[-1]
+    with open(fn, 'rt') as fd:
+        log = fd.read()
+
+    for m in msgs:
+        sha = b2a_hex(sha256(m).digest()).decode('ascii')
+        assert ('-- messages %s --' % sha) in log
+        assert ('SHA256(msg) = ' + sha) in log
+
+    assert log.count('APPROVED: Message signing allowed') >= len(msgs)
+    assert os.path.getsize(fn) <= 1024*1024
+
 def test_never_log(dev, start_hsm, attempt_msg_sign, fake_txn, attempt_psbt, sd_cards_eject):
     # never try to log anything
     policy = DICT(never_log=True, msg_paths=['m'], rules=[{}])
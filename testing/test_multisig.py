@@ -2933,4 +2933,24 @@ def test_bare_cc_ms_qr_import(N, make_multisig, scan_a_qr, clear_ms, goto_home,
     assert f"{N}-of-{N}" in story
     press_cancel()
 
+def test_ms_index_refresh(clear_ms, import_ms_wallet, dev):
+    # in-memory wallet index must follow imports and wipes
+    clear_ms()
+    keys = import_ms_wallet(2, 3, name='idx-a', accept=1)
+
+    xor = 0
+    for xfp, _, _ in keys:
+        xor ^= xfp
+
+    assert dev.send_recv(CCProtocolPacker.multisig_check(2, 3, xor)) == 1
+    assert dev.send_recv(CCProtocolPacker.multisig_check(3, 3, xor)) == 0
+
+    # same XFP set, different M: same index bucket
+    import_ms_wallet(3, 3, name='idx-b', keys=keys, accept=1)
+    assert dev.send_recv(CCProtocolPacker.multisig_check(2, 3, xor)) == 1
+
+    clear_ms()
+    assert dev.send_recv(CCProtocolPacker.multisig_check(2, 3, xor)) == 0
+    assert dev.send_recv(CCProtocolPacker.multisig_check(3, 3, xor)) == 0
+
 # EOF
@@ -151,6 +151,57 @@ def test_positive(addr_fmt, offset, subaccount, testnet, from_empty, change_idx,
 
     assert got_path == (change_idx, offset)
 
+def test_upgrade_v1(wipe_cache, sim_exec, use_testnet):
+    # older v1.0 files (hashes only, in index order) are converted on first use
+    use_testnet(True)
+    wipe_cache()
+
+    cmd = '''\
+import struct, ownership
+from wallet import MasterSingleSigWallet
+from public_constants import AF_P2WPKH
+w = MasterSingleSigWallet(AF_P2WPKH)
+f = ownership.AddressCacheFile(w, 0)
+with open(f.fname, 'wb') as fd:
+    fd.write(struct.pack(ownership.OWNERSHIP_FILE_HDR, ownership.OWNERSHIP_MAGIC_V1, 0, 0))
+    for _, a, _ in w.yield_addresses(0, 50, change_idx=0):
+        fd.write(ownership.encode_addr(a, f.salt))
+addr = w.render_address(0, 33)
+f = ownership.AddressCacheFile(w, 0)
+hits = []
+for m in f.fast_search(addr):
+    if f.check_match(addr, m): hits.append(m)
+RV.write(repr([hex(f.hdr.file_magic), f.count, hits, ownership.OWNERSHIP.search(addr)[1]]))
+'''
+    lst = sim_exec(cmd)
+    assert 'Traceback' not in lst, lst
+
+    magic, count, hits, found = eval(lst)
+    assert magic == '0x10a1'
+    assert count == 50
+    assert hits == [(0, 33)]
+    assert found == (0, 33)
+
+def test_background_build(wipe_cache, sim_exec, goto_home, settings_set):
+    # sitting idle at top menu, cache files get built w/o any search
+    settings_set('accts', [])
+    goto_home()
+    wipe_cache()
+
+    cmd = 'import ownership; from wallet import MasterSingleSigWallet; '\
+          'from public_constants import AF_P2WPKH; '\
+          'RV.write(repr(ownership.AddressCacheFile(MasterSingleSigWallet(AF_P2WPKH), 0).count))'
+
+    assert int(sim_exec(cmd)) == 0
+
+    # idle time needed, then some chunks
+    for _ in range(30):
+        time.sleep(2)
+        if int(sim_exec(cmd)):
+            break
+    else:
+        raise pytest.fail('no background progress')
+
 @pytest.mark.parametrize('valid', [ True, False] )
 @pytest.mark.parametrize('testnet', [ True, False] )
 @pytest.mark.parametrize('method', [ 'qr', 'nfc'] )
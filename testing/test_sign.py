@@ -170,6 +170,155 @@ def test_speed_test(dev, fake_txn, is_mark3, is_mark4, start_sign, end_sign,
     print("  Tx time: %.1f" % tx_time)
     print("Sign time: %.1f" % ready_time)
 
+@pytest.mark.veryslow
+@pytest.mark.unfinalized
+def test_legacy_sighash_speed(dev, fake_txn, start_sign, end_sign):
+    # signing time vs. input count for legacy (p2pkh) inputs
+    # - used to be quadratic, since whole txn was re-parsed for each input signed
+    # - cmdline: "pytest test_sign.py -k test_legacy_sighash_speed -s"
+    results = []
+    for num_in in [10, 50, 100, 200]:
+        psbt = fake_txn(num_in, 2, dev.master_xpub, segwit_in=False)
+
+        start_sign(psbt, finalize=False)
+        dt = time.time()
+        signed = end_sign(accept=True, finalize=False)
+        results.append((num_in, time.time() - dt))
+
+        assert signed != psbt
+
+    for num_in, sign_time in results:
+        print("%4d inputs: %6.1f sec  (%.3f per input)" % (num_in, sign_time, sign_time/num_in))
+
+    # per-input cost should be fairly flat; allow lots of slop for simulator noise
+    per_in = [t/n for n,t in results]
+    assert per_in[-1] < 4 * per_in[1]
+
+@pytest.mark.unfinalized
+def test_approval_phase_timing(dev, fake_txn, start_sign, end_sign):
+    # PERF test command reports phase timings of most recent approval
+    import json
+
+    psbt = fake_txn(5, 2, dev.master_xpub, segwit_in=False, outstyles=['p2pkh'], change_outputs=[1])
+
+    start_sign(psbt, finalize=False)
+    signed = end_sign(accept=True, finalize=False)
+    assert signed != psbt
+
+    phases = json.loads(dev.send_recv(b'PERF'))
+    names = [p['phase'] for p in phases]
+
+    for nm in ['read_psbt', 'validate', 'consider_inputs', 'consider_dangerous_change',
+                    'consider_outputs', 'sign_it.change', 'sign_it.digests', 'sign_it.keys',
+                    'sign_it.signatures', 'sign_it', 'serialize']:
+        assert nm in names, nm
+
+    assert names.index('read_psbt') < names.index('sign_it') < names.index('serialize')
+    for p in phases:
+        assert p['ms'] >= 0
+
+def batch_upload(dev, psbts):
+    # put PSBT's into batch slots, return args for bsig cmd
+    from hashlib import sha256
+
+    items = b''
+    for slot, psbt in enumerate(psbts):
+        for pos in range(0, len(psbt), 1024):
+            rv = dev.send_recv(b'bupl' + struct.pack('<III', slot, pos, len(psbt))
+                                    + psbt[pos:pos+1024])
+            assert rv == pos
+
+        items += struct.pack('<I32s', len(psbt), sha256(psbt).digest())
+
+    return struct.pack('<II', len(psbts), 0) + items
+
+def batch_download(dev, slot, length):
+    rv = b''
+    while len(rv) < length:
+        rv += dev.send_recv(b'bdwl' + struct.pack('<III', slot, len(rv),
+                                                    min(1024, length-len(rv))))
+    return rv
+
+def set_abs_locktime(lock_time):
+    # psbt_hacker for fake_txn: absolute locktime which is in effect (not final nSequence)
+    def doit(psbt):
+        t = CTransaction()
+        t.deserialize(BytesIO(psbt.txn))
+        t.nLockTime = lock_time
+        for i in t.vin:
+            i.nSequence = 0xfffffffe
+        psbt.txn = t.serialize_with_witness()
+
+    return doit
+
+@pytest.mark.unfinalized
+@pytest.mark.parametrize('num_txn', [1, 5])
+def test_batch_sign_usb(num_txn, dev, fake_txn, cap_story, press_select, press_cancel):
+    from hashlib import sha256
+
+    # every 2nd one has a locktime, which must be shown for that txn
+    psbts = [fake_txn(i+1, 2, dev.master_xpub, segwit_in=True, change_outputs=[1],
+                        psbt_v2=False,
+                        psbt_hacker=(set_abs_locktime(800000+i) if i % 2 else None))
+                    for i in range(num_txn)]
+
+    dev.send_recv(b'bsig' + batch_upload(dev, psbts))
+    time.sleep(.2)
+
+    title, story = cap_story()
+    assert title == 'OK TO SEND?'
+    assert ('%d transactions' % num_txn) in story
+    assert ('Transaction %d of %d' % (num_txn, num_txn)) in story
+
+    sections = story.split('--- Transaction ')[1:]
+    assert len(sections) == num_txn
+    for i, sect in enumerate(sections):
+        if i % 2:
+            assert 'TX LOCKTIMES' in sect
+            assert 'block height of %d' % (800000+i) in sect
+        else:
+            assert 'LOCKTIMES' not in sect
+
+    press_select()
+
+    for _ in range(100):
+        resp = dev.send_recv(b'bsok', timeout=None)
+        if resp is not None:
+            break
+        time.sleep(0.1)
+
+    count, = struct.unpack_from('<I', resp)
+    assert count == num_txn
+
+    for slot, psbt in enumerate(psbts):
+        status, ln, sha = struct.unpack_from('<BI32s', resp, 4 + (slot * 37))
+        assert status == 0
+
+        signed = batch_download(dev, slot, ln)
+        assert sha256(signed).digest() == sha
+        assert signed[0:5] == b'psbt\xff'
+        assert signed != psbt
+
+        got = BasicPSBT().parse(signed)
+        assert all(len(i.part_sigs) == 1 for i in got.inputs)
+
+def test_batch_refused(dev, fake_txn, cap_story, press_cancel):
+    psbts = [fake_txn(1, 1, dev.master_xpub, segwit_in=True) for i in range(3)]
+
+    dev.send_recv(b'bsig' + batch_upload(dev, psbts))
+    time.sleep(.2)
+
+    title, story = cap_story()
+    assert '3 transactions' in story
+
+    press_cancel()
+
+    with pytest.raises(CCUserRefused):
+        for _ in range(100):
+            if dev.send_recv(b'bsok', timeout=None) is not None:
+                break
+            time.sleep(0.1)
+
 if 0:
     # TODO: attempt to re-create the mega transaction: 5,569 inputs, one out
     # see <https://bitcoin.stackexchange.com/questions/11542>
@@ -139,6 +139,10 @@ def test_decoding(unit_test):
     # utils.py Hex/Base64 streaming decoders
     unit_test('devtest/unit_decoding.py')
 
+def test_derive_cache(unit_test):
+    # stash.py SensitiveValues.derive_path w/ cached parent nodes
+    unit_test('devtest/unit_derive_cache.py')
+
 @pytest.mark.parametrize('hasher', ['sha256', 'sha1', 'sha512'])
 @pytest.mark.parametrize('msg', [b'123', b'b'*78])
 @pytest.mark.parametrize('key', [b'3245', b'b'*78])
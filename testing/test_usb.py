@@ -224,4 +224,40 @@ def test_remote_up_download(f_len, dev, mk_num):
     rb = dev.download_file(ll, sha, file_number=0)
     assert rb == data
 
+@pytest.mark.parametrize('f_len', [64*1024, 1024*1024])
+def test_throughput(f_len, dev):
+    # bulk transfer speed, each way, using biggest blocks the protocol allows
+    import os, time
+
+    data = os.urandom(f_len)
+
+    t = time.time()
+    ll, sha = dev.upload_file(data)
+    up = time.time() - t
+    assert ll == f_len
+
+    t = time.time()
+    rb = dev.download_file(ll, sha, file_number=0)
+    down = time.time() - t
+    assert rb == data
+
+    print("%7d bytes: upload %.1f KiB/s, download %.1f KiB/s"
+                % (f_len, f_len / up / 1024, f_len / down / 1024))
+
+def test_latency_stats(dev):
+    # per-command latency counters, kept on simulator and dev builds
+    import json
+
+    dev.send_recv(b'USBS' + b'reset')
+    for i in range(10):
+        dev.send_recv(CCProtocolPacker.ping(b'hello'))
+    dev.send_recv(CCProtocolPacker.sha256())
+
+    stats = json.loads(dev.send_recv(b'USBS'))
+    count, total_us, max_us = stats['ping']
+    assert count == 10
+    assert 0 <= max_us <= total_us
+    assert stats['sha2'][0] == 1
+    assert 'USBS' not in stats
+
 # EOF
@@ -11,6 +11,7 @@ freeze_as_mpy('', [
 	'sim_battery.py',
 	'sim_scanner.py',
 	'sim_nfc.py',
+	'sim_psbt.py',
 	'sim_psram.py',
 	'sim_quickstart.py',
 	'sim_secel.py',
@@ -0,0 +1,50 @@
+# (c) Copyright 2024 by Coinkite Inc. This file is covered by license found in COPYING-CC.
+#
+# sim_psbt.py -- SIMULATED signature stage of PSBT signing, on a pool of threads
+#
+# - lets CI measure throughput of large PSBTs; real device is single threaded
+#
+import _thread, utime
+
+NUM_WORKERS = 4
+
+def pool_signer(sign_one):
+    # wrap psbt.sign_digest into a replacement for psbt.sign_digests
+
+    def sign_digests(work):
+        rv = [None] * len(work)
+        lock = _thread.allocate_lock()
+        state = dict(next=0, running=0, error=None)
+
+        def worker():
+            try:
+                while 1:
+                    with lock:
+                        n = state['next']
+                        if n >= len(work) or state['error']:
+                            break
+                        state['next'] = n + 1
+
+                    rv[n] = sign_one(*work[n])
+            except BaseException as exc:
+                state['error'] = exc
+            finally:
+                with lock:
+                    state['running'] -= 1
+
+        num = min(NUM_WORKERS, len(work))
+        state['running'] = num
+        for i in range(num):
+            _thread.start_new_thread(worker, ())
+
+        while state['running']:
+            utime.sleep_ms(1)
+
+        if state['error']:
+            raise state['error']
+
+        return rv
+
+    return sign_digests
+
+# EOF